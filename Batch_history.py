@@ -1,3 +1,6 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
 # Own modules:
 from Logging import Logger
 
@@ -25,35 +28,82 @@ class BatchHistory:
         self.logger.info('Creating Batch History')
 
     def apply(self, df):
-        # Initialize the dicts:
+        """
+        Create the batch dictionary from the dataframe in a single vectorized pass. Rows where either the FROM Batch or
+        the TO Batch is empty are ignored. The FROM Batch numbers keep the order in which they first appear in the
+        dataframe.
+
+        :param df: pandas dataframe with the columns 'FROM Batch' and 'TO Batch'
+        :return: batch dictionary
+        """
+        links = df[['FROM Batch', 'TO Batch']].dropna().drop_duplicates()
+        batch_dict = links.groupby('TO Batch', sort=False)['FROM Batch'].agg(list).to_dict()
+        # Intern the batch numbers, so every batch number is stored once and dictionary lookups are faster:
+        batch_dict = {_intern(to_batch): [_intern(from_batch) for from_batch in from_batch_list]
+                      for to_batch, from_batch_list in batch_dict.items()}
+
+        self.logger.info('Finished creating Batch History.')
+        return batch_dict
+
+    def apply_chunks(self, chunks):
+        """
+        Create the batch dictionary from a dataframe that is read in chunks, for example using
+        pd.read_csv(filelocation, chunksize=100000). The result is the same as running apply() on the complete
+        dataframe, but only one chunk needs to be in memory at a time.
+
+        :param chunks: iterable of pandas dataframes with the columns 'FROM Batch' and 'TO Batch'
+        :return: batch dictionary
+        """
         batch_dict = {}
-        for index, row in df.iterrows():
-            batch_dict = self.update_to_batch_dict(row, batch_dict)
+        seen = {}  # the FROM Batch numbers per TO Batch as a set
+        for chunk in chunks:
+            links = chunk[['FROM Batch', 'TO Batch']].dropna().drop_duplicates()
+            # Same logic as update_to_batch_dict(), written out here to save a function call per row:
+            for from_batch, to_batch in zip(links['FROM Batch'], links['TO Batch']):
+                from_batch_set = seen.get(to_batch)
+                if from_batch_set is None:
+                    to_batch = _intern(to_batch)
+                    seen[to_batch] = {from_batch}
+                    batch_dict[to_batch] = [_intern(from_batch)]
+                elif from_batch not in from_batch_set:
+                    from_batch_set.add(from_batch)
+                    batch_dict[to_batch].append(_intern(from_batch))
 
         self.logger.info('Finished creating Batch History.')
-        # return both dictionaries:
         return batch_dict
 
     @staticmethod
-    def update_to_batch_dict(row, batch_dict):
+    def update_to_batch_dict(row, batch_dict, seen=None):
         """
         This function adds the link between the TO Batch and FROM batch to the to_batch dictionary (if it doesnt' exist
         already).
 
+        When calling this function for many rows, pass the same (initially empty) [seen] dictionary every time. It keeps
+        a set of FROM Batch numbers per TO Batch, so the duplicate check no longer scans the list of FROM Batch numbers.
+
+        NOTE: apply() and apply_chunks() don't use this function, it is kept for scripts that build the batch dictionary
+        row by row.
+
         :param row: pandas dataframe row
         :param batch_dict: batch dictionary
+        :param seen: (OPTIONAL) dictionary linking each TO Batch to the set of FROM Batch numbers already added
         :return: updated batch_dict
         """
         from_batch = row['FROM Batch']
         to_batch = row['TO Batch']
-        if to_batch not in batch_dict:
-            batch_dict[to_batch] = [from_batch]
+        if seen is not None:
+            from_batch_set = seen.get(to_batch)
+            if from_batch_set is None:
+                # Start from the FROM Batch numbers that might already be in the batch dictionary:
+                from_batch_set = seen[to_batch] = set(batch_dict.setdefault(to_batch, []))
+            if from_batch not in from_batch_set:
+                from_batch_set.add(from_batch)
+                batch_dict[to_batch].append(from_batch)
         else:
             # Check if the from_batch is not already in the list, if not, add:
-            from_batch_list = batch_dict[to_batch]
+            from_batch_list = batch_dict.setdefault(to_batch, [])
             if from_batch not in from_batch_list:
                 from_batch_list.append(from_batch)
-                batch_dict[to_batch] = from_batch_list
         return batch_dict
 
 
@@ -65,7 +115,9 @@ class ReconstructPaths:
 
     It also takes a list of batch numbers as input. For each batch number in this list it will recursively look up from
     where this batch number originates using the dictionairy. It saves all possible paths to a dictionary with the
-    batch number as key and the paths as value in the form of a list of lists. It returns the path dictionary.
+    batch number as key and the paths as value in the form of a list of tuples. It returns the path dictionary.
+    The paths are tuples so they can't be changed by accident and can be used as dictionary keys, use list(path) to
+    get a path that can be changed.
 
     Example:
         INPUT:
@@ -82,16 +134,12 @@ class ReconstructPaths:
         OUTPUT:
         path_dict = {
         '0190711962': [
-        ['0180875848', '0182299633', '0182548562', '0190711962'],
-        ['0182268100', '0182548565', '0190711962'],
-        ['0182778155', '0190711962']]
+        ('0180875848', '0182299633', '0182548562', '0190711962'),
+        ('0182268100', '0182548565', '0190711962'),
+        ('0182778155', '0190711962')]
 
     """
 
-    edges = {}
-    paths = []
-    sources = []
-
     def __init__(self, loglevel=None):
         if loglevel is not None:
             self.logger = Logger('retrieve_batch_history.ReconstructPaths', loglevel).logger
@@ -99,122 +147,257 @@ class ReconstructPaths:
             self.logger = Logger('retrieve_batch_history.ReconstructPaths', 'INFO').logger
         self.logger.info('Reconstructing Paths')
         self.path_dictionary = {}
+        self.edges = {}  # dict to save the edges
+        self.paths = []  # list to save the paths
+        self.sources = []  # list to save the source batch numbers
 
-    def apply(self, batch_dict, to_batch_list):
-        # For each to_batch number, identify all paths and add the paths to the path_dictionary with to_batch as key.
-        for to_batch in to_batch_list:
-            self.edges = {}  # dict to save the edges
-            self.paths = []  # list to save the paths
-            self.sources = []  # list to save the source batch numbers
-            # Add the final node to the edges dictionary:
-            self.edges = self.add_edge(to_batch, None, self.edges)
-            # Add the other edges:
-            self.add_edges(batch_dict, to_batch)
-            # Determine the paths:
-            for source in self.sources:
-                self.determine_all_paths(source, to_batch, self.edges)
-            # Add the paths to the dict:
-            self.path_dictionary[to_batch] = self.paths
+    def apply(self, batch_dict, to_batch_list, processes=1):
+        """
+        For each to_batch number, identify all paths and add the paths to the path_dictionary with to_batch as key.
+
+        The to_batch numbers are independent of each other, so they can be handled by multiple processes. This pays off
+        for long to_batch lists, starting the processes and sending them the batch dictionary takes time as well.
+        On Windows, scripts using multiple processes need to call this function from within an
+        `if __name__ == '__main__':` block.
+
+        :param batch_dict: a dictionary linking TO Batch numbers to FROM batch numbers.
+        :param to_batch_list: a list of to batch numbers
+        :param processes: (OPTIONAL) number of processes to use (default=1), None uses one process per CPU.
+        :return: the path dictionary
+        """
+        to_batch_list = [_intern(to_batch) for to_batch in to_batch_list]
+        if processes == 1:
+            for to_batch in to_batch_list:
+                self.path_dictionary[to_batch] = self.reconstruct(batch_dict, to_batch)
+        else:
+            # Hand out the to_batch numbers in chunks, every process receives the batch dictionary only once:
+            chunksize = max(1, len(to_batch_list) // (4 * (processes or os.cpu_count() or 1)))
+            with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                                     initargs=(batch_dict, self.logger.level)) as executor:
+                for to_batch, paths in executor.map(_reconstruct_one, to_batch_list, chunksize=chunksize):
+                    self.path_dictionary[to_batch] = paths
         self.logger.info('Finished reconstructing paths.')
         return self.path_dictionary
 
-    def add_edges(self, batch_dict, to_batch):
+    def reconstruct(self, batch_dict, to_batch):
         """
-        This is a recursive function to add all edges (FROM Batch -> TO Batch) to a dictionary, where the FROM Batch is
-        the key and the TO Batch is the value. It will start with the input [to_batch] and retrieve the list of
-        FROM batch numbers from the [batch_dict]. For each FROM batch number, it will edge the edge (from->to) and then
-        check whether this from batch number is also a to batch number. If so, this function will call itself but now
-        using the from batch number as to batch number. If the from batch number is not also a to batch number, this
-        batch number is a source batch (we can not go further back from here in the history of the batch). So this
-        number is added to the sources list.
+        This function identifies all paths from the source batches to a single to_batch number.
 
         :param batch_dict: a dictionary linking TO Batch numbers to FROM batch numbers.
-        :param to_batch: a single to batch number (as string)
-        :return: Filled the edges dictionary and the sources list.
-        """
-        if to_batch in batch_dict:
-            from_batch_list = batch_dict[to_batch]
-            for from_batch in from_batch_list:
-                self.edges = self.add_edge(from_batch, to_batch, self.edges)
-                if from_batch in batch_dict:  # if from_batch is also a TO Batch, let the function call itself again
-                    self.add_edges(batch_dict, from_batch)
-                else:
-                    self.sources.append(from_batch)
+        :param to_batch: a single to batch number
+        :return: list of paths (tuples)
+        """
+        self.paths = []  # list to save the paths
+        if not self.collect_history(batch_dict, to_batch):
+            return self.paths
+        # Determine the paths:
+        paths_to_batch = self.determine_paths_to(to_batch, self.sources, self.edges)
+        if paths_to_batch is not None:
+            for source in self.sources:
+                self.paths.extend(paths_to_batch[source])
         else:
+            self.logger.warning('The history of {} contains a cycle, searching the paths one by one.'.format(to_batch))
+            for source in self.sources:
+                self.determine_all_paths(source, to_batch, self.edges)
+        return self.paths
+
+    def collect_history(self, batch_dict, to_batch):
+        """
+        This function adds all edges (FROM Batch -> TO Batch) in the history of the input [to_batch] to the edges
+        dictionary, where the FROM Batch is the key and the list of TO Batches is the value. It will start with
+        [to_batch] and retrieve the list of FROM batch numbers from the [batch_dict]. For each FROM batch number, it
+        adds the edge (from->to) and then checks whether this from batch number is also a to batch number. If so, it
+        continues with the history of the from batch number first before handling the next from batch number. If the
+        from batch number is not also a to batch number, this batch number is a source batch (we can not go further
+        back from here in the history of the batch). So this number is added to the sources list.
+        A FROM batch number that is already in the edges dictionary has been handled before (it is shared by multiple
+        descendants), so only the new edge is added. The edges are added in one pass over the history, the batches
+        still being handled are kept on an explicit stack, so long histories can not hit the recursion limit.
+
+        :param batch_dict: a dictionary linking TO Batch numbers to FROM batch numbers.
+        :param to_batch: a single to batch number (as string)
+        :return: True if the history was collected, False if [to_batch] is not in the batch dictionary.
+        """
+        # The final node has no neighbours:
+        self.edges = {to_batch: []}  # dict to save the edges
+        self.sources = []  # list to save the source batch numbers
+        if to_batch not in batch_dict:
             self.logger.error('{} not found in the Batch dictionary.'.format(to_batch))
+            return False
+        # Bind the objects used in the loop to local names, these are faster to look up:
+        edges = self.edges
+        sources_append = self.sources.append
+        stack = [(to_batch, iter(batch_dict[to_batch]))]
+        stack_append, stack_pop = stack.append, stack.pop
+        while stack:
+            node, from_batches = stack[-1]
+            for from_batch in from_batches:
+                neighbours = edges.get(from_batch)
+                if neighbours is not None:
+                    # from_batch has been handled before, only add the new edge:
+                    neighbours.append(node)
+                    continue
+                edges[from_batch] = [node]
+                if from_batch in batch_dict:
+                    # from_batch is also a TO Batch, continue with its history first:
+                    stack_append((from_batch, iter(batch_dict[from_batch])))
+                    break
+                sources_append(from_batch)
+            else:
+                stack_pop()
+        return True
+
+    def iter_paths(self, batch_dict, to_batch):
+        """
+        This function yields the paths from the source batches to a single to_batch number one at a time, instead of
+        collecting them all in memory first. Use it for batches with a very large number of paths, for example to
+        write the paths straight to a file or database.
+
+        :param batch_dict: a dictionary linking TO Batch numbers to FROM batch numbers.
+        :param to_batch: a single to batch number
+        :return: generator of paths (tuples)
+        """
+        if self.collect_history(batch_dict, to_batch):
+            for source in self.sources:
+                yield from self.iter_all_paths(source, to_batch, self.edges)
+
+    def determine_all_paths(self, s, d, edges, reachable=None):
+        """
+        This function finds all paths from the source (s) to the destination (d) and adds them to the paths list.
+        See iter_all_paths() for the parameters.
+
+        """
+        self.paths.extend(self.iter_all_paths(s, d, edges, reachable))
 
     @staticmethod
-    def add_edge(u, v, edges):
+    def iter_all_paths(s, d, edges, reachable=None):
         """
-        Helper function to add edges to the edges dictionary. Adds an empty list of destination node (v) is None.
+        This function yields all paths from the source (s) to the destination (d).
+        It does a depth first search with an explicit stack instead of recursion, so deep batch histories can not hit
+        the recursion limit. Only the current path is kept in memory.
+        The stack holds an iterator over the neighbours of every node in the current path. The function takes the next
+        neighbour of the node on top of the stack. If this neighbour is the destination, the path is yielded, if it
+        has not been visited yet it is added to the path and its neighbours are put on the stack.
+        Once all neighbours of a node have been tried, the node is removed from the path and marked as unvisited again.
+
+        The edges created by collect_history() only contain batches that lead to the destination. When searching a
+        larger edges dictionary, pass the nodes that can reach the destination (see nodes_reaching()) as [reachable],
+        so the search skips the parts of the graph that can never lead to the destination.
 
-        :param u: origin node
-        :param v: destination node
+        :param s: source node (source batch)
+        :param d: destination node (destination batch)
         :param edges: edges dictionary
+        :param reachable: (OPTIONAL) set of nodes from which the destination can be reached
+        :return: generator of paths (tuples)
         """
-        if v is None:
-            # The final node will end up here and has no neighbours
-            edges[u] = []
-        else:
-            # Make sure that this edge does not already exists
-            if not (u in edges and v in edges[u]):
-                edges.setdefault(u, []).append(v)
-        return edges
-
-    def determine_all_paths_util(self, u, d, visited, path, edges):
-        """
-        A recursive function to print all paths from the origin (u) to the destination (d).
-        visited{} keeps track of vertices in current path.
-        path[] stores actual vertices
-        The function will set visited = True for the origin and add it to the path. It will then check whether this is
-        the destination, if so, it adds the path to the paths list.
-        Otherwise, it will retrieve all nodes to which it can go from this origin, and if not visited, call itself on
-        that node again. Once done with a particular path, it will reset the path list.
-        It continues untill it has taken all options.
-
-        :param u: origin node
-        :param d: destination node
-        :param visited: dictionary with node as key, to keep track which nodes have been visited.
-        :param path: list to store the path
+
+        # Start the path at the source, visited keeps track of the vertices in the current path:
+        visited = {s}
+        if reachable is not None:
+            # Nodes that can't reach the destination are never entered, treat them as visited:
+            visited.update(node for node in edges if node not in reachable)
+        path = [s]
+        stack = [iter(edges[s])]
+        # Bind the methods used in the loop to local names, these are faster to look up:
+        visited_add, visited_discard = visited.add, visited.discard
+        path_append, path_pop = path.append, path.pop
+        stack_append, stack_pop = stack.append, stack.pop
+        while stack:
+            for v in stack[-1]:
+                if v == d:
+                    # The search only follows unvisited nodes, so every path is found exactly once:
+                    yield tuple(path) + (v,)
+                elif v not in visited:
+                    # Continue the search from this neighbour:
+                    visited_add(v)
+                    path_append(v)
+                    stack_append(iter(edges[v]))
+                    break
+            else:
+                # All neighbours have been tried, remove the current vertex from path and mark it as unvisited
+                stack_pop()
+                visited_discard(path_pop())
+
+    @staticmethod
+    def nodes_reaching(d, edges):
+        """
+        This function returns the set of nodes from which the destination (d) can be reached, including d itself.
+        It walks the edges backwards starting from the destination.
+
+        :param d: destination node (destination batch)
         :param edges: edges dictionary
+        :return: set of nodes
         """
-        # Mark the current node as visited and store in path
-        visited[u] = True
-        path.append(u)
+        reverse_edges = {}
+        for u, neighbours in edges.items():
+            for v in neighbours:
+                reverse_edges.setdefault(v, []).append(u)
+        reachable = {d}
+        stack = [d]
+        while stack:
+            for u in reverse_edges.get(stack.pop(), []):
+                if u not in reachable:
+                    reachable.add(u)
+                    stack.append(u)
+        return reachable
 
-        # If current vertex is same as destination, then print
-        # current path[]
-        if u == d:
-            if path not in self.paths:
-                # Add a copy of the path because otherwise the path.pop will delete everything again afterwards:
-                self.paths.append(path.copy())
-        else:
-            # If current vertex is not destination
-            # Recur for all the vertices adjacent to this vertex
-            for i in edges[u]:
-                if not visited[i]:
-                    self.determine_all_paths_util(i, d, visited, path, edges)
+    @staticmethod
+    def determine_paths_to(d, sources, edges):
+        """
+        This function determines all paths from each source to the destination (d) at once. Sources often share part
+        of their history (batches that were merged), so instead of searching the graph again for every source, the
+        paths from a node to the destination are determined once and reused by every node that leads to it:
 
-        # Remove current vertex from path[] and mark it as unvisited
-        path.pop()
-        visited[u] = False
+            paths from u = [(u,) + path for each neighbour v of u for each path in paths from v]
 
-    def determine_all_paths(self, s, d, edges):
-        """
-        This function finds all paths from the source (s) to the destination (d) using determine_all_paths_util.
+        The nodes are handled in post-order (all neighbours of a node before the node itself) using an explicit stack.
+        The paths are returned in the same order as determine_all_paths() would find them.
+        This only works if the edges do not contain a cycle, in that case None is returned.
 
-        :param s: source node (source batch)
         :param d: destination node (destination batch)
+        :param sources: list of source nodes (source batches)
         :param edges: edges dictionary
+        :return: dictionary with every node that leads to the destination as key and its paths as value, or None.
         """
+        paths_to_d = {d: [(d,)]}
+        for s in sources:
+            if s in paths_to_d:
+                continue
+            on_stack = {s}
+            stack = [(s, iter(edges[s]))]
+            while stack:
+                u, neighbours = stack[-1]
+                for v in neighbours:
+                    if v in on_stack:
+                        return None
+                    if v not in paths_to_d:
+                        on_stack.add(v)
+                        stack.append((v, iter(edges[v])))
+                        break
+                else:
+                    # All neighbours are done, combine their paths:
+                    stack.pop()
+                    on_stack.discard(u)
+                    paths_to_d[u] = [(u,) + path for v in edges[u] for path in paths_to_d[v]]
+        return paths_to_d
+
+
+def _intern(batch):
+    """
+    Interns batch numbers given as string, other types are returned as they are.
+
+    """
+    return sys.intern(batch) if type(batch) is str else batch
+
+
+# The batch dictionary and ReconstructPaths object of a worker process started by ReconstructPaths.apply():
+_worker = {}
+
 
-        # Mark all the vertices as not visited
-        visited = {}
-        for key in edges.keys():
-            visited[key] = False
+def _init_worker(batch_dict, loglevel):
+    _worker['batch_dict'] = batch_dict
+    _worker['reconstruct_paths'] = ReconstructPaths(loglevel)
 
-        # Create an array to store paths
-        path = []
 
-        # Call the recursive helper function to print all paths
-        self.determine_all_paths_util(s, d, visited, path, edges)
+def _reconstruct_one(to_batch):
+    return to_batch, _worker['reconstruct_paths'].reconstruct(_worker['batch_dict'], to_batch)
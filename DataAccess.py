@@ -6,10 +6,16 @@ __version__ = "0.1"
 __email__ = "chris.jacobs@bayer.com"
 
 # Imports
+import csv
 from datetime import datetime
 import time
+import io
+import json
 import os
+import pickle
+import struct
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
 import pandas as pd
 from sqlalchemy import create_engine
@@ -26,19 +32,71 @@ class ReadData:
     def __init__(self, loglevel='INFO'):
         self.logger = Logger('DataAccess.ReadData', loglevel).logger
 
-    def read_csv_to_df(self, filelocation, sep=',', dtype_dict=None):
+    def read_csv_to_df(self, filelocation, sep=',', dtype_dict=None, engine=None, usecols=None, parse_dates=None,
+                       low_memory=False):
         """
         This function reads a csv file to a pandas dataframe and returns that dataframe.
 
+        The pyarrow engine (engine='pyarrow') parses the file with multiple threads, which is a lot faster for large
+        csv files. It needs pandas >= 1.4 and pyarrow, and only supports single character separators. When the engine
+        can not be used, the file is read with the default (C) engine instead.
+
+        By default the file is parsed in one go (low_memory=False), so every column gets its final dtype directly
+        instead of parsing the file in chunks and combining the dtypes of the chunks afterwards. Giving the dtypes
+        [dtype_dict] and the columns that are needed [usecols] lets pandas skip the dtype inference and only create
+        the needed columns.
+
         :param filelocation: full path to the file location of the csv-file.
         :param sep: separator (OPTIONAL; default = ',')
         :param dtype_dict: (OPTIONAL) Dictionary of datatypes with {'column_name': 'dtype'}
+        :param engine: (OPTIONAL) the parser engine to use: 'c', 'python' or 'pyarrow' (default = None, pandas default)
+        :param usecols: (OPTIONAL) list of the columns to read, default is all columns.
+        :param parse_dates: (OPTIONAL) list of the columns to parse as dates.
+        :param low_memory: (OPTIONAL) parse the file in chunks to use less memory while parsing (default = False), only
+            used by the C engine.
         :return: pandas dataframe
         """
+        kwargs = {'sep': sep, 'usecols': usecols, 'parse_dates': parse_dates}
         if dtype_dict is not None:
-            df = pd.read_csv(filelocation, sep=sep, dtype=dtype_dict)
+            kwargs['dtype'] = dtype_dict
+        if engine == 'pyarrow' and len(sep) != 1:
+            self.logger.warning('The pyarrow engine does not support separator {}, using the default engine.'
+                                .format(sep))
+            engine = None
+        if engine in (None, 'c'):
+            kwargs['low_memory'] = low_memory
+        if engine is not None:
+            try:
+                df = pd.read_csv(filelocation, engine=engine, **kwargs)
+            except (ImportError, ValueError) as ex:
+                # The engine is not available in this pandas version or can not handle the given dtypes:
+                self.logger.warning('Reading {} with the {} engine failed ({}), using the default engine.'
+                                    .format(filelocation, engine, ex))
+                kwargs['low_memory'] = low_memory
+                df = pd.read_csv(filelocation, **kwargs)
         else:
-            df = pd.read_csv(filelocation, sep=sep)
+            df = pd.read_csv(filelocation, **kwargs)
+        self.logger.info('{} read to dataframe.'.format(filelocation))
+        return df
+
+    def read_csv_arrow(self, filelocation, sep=',', dtype_dict=None):
+        """
+        This function reads a csv file with the pyarrow csv reader instead of the pandas parser and returns a pandas
+        dataframe. The pyarrow reader parses the file with multiple threads into columns, use it for large csv files
+        (mostly numbers) where reading the file takes long.
+
+        :param filelocation: full path to the file location of the csv-file.
+        :param sep: separator, a single character (OPTIONAL; default = ',')
+        :param dtype_dict: (OPTIONAL) Dictionary of datatypes with {'column_name': 'dtype'}, the dtypes can be numpy
+            dtypes or pyarrow types.
+        :return: pandas dataframe
+        """
+        from pyarrow import csv as pacsv
+
+        convert_options = pacsv.ConvertOptions(column_types=dtype_dict) if dtype_dict is not None else None
+        table = pacsv.read_csv(filelocation, read_options=pacsv.ReadOptions(use_threads=True),
+                               parse_options=pacsv.ParseOptions(delimiter=sep), convert_options=convert_options)
+        df = table.to_pandas()
         self.logger.info('{} read to dataframe.'.format(filelocation))
         return df
 
@@ -49,15 +107,56 @@ class ReadData:
         :param filelocation: full path to the file location of the csv-file.
         :return: pandas dataframe
         """
+        self.logger.warning('Pickle (pk1) files are deprecated, use parquet files instead (read_parquet_to_df).')
         df = pd.read_pickle(filelocation)
         self.logger.info('{} read to dataframe.'.format(filelocation))
         return df
 
+    def read_parquet_to_df(self, filelocation, columns=None, filters=None):
+        """
+        This function reads a parquet file to a pandas dataframe and returns that dataframe.
+        Only the requested columns are read from the file and with filters whole parts of the file can be skipped, so
+        only reading what is needed is much faster than reading the complete file and selecting afterwards.
+
+        :param filelocation: full path to the file location of the parquet-file.
+        :param columns: (OPTIONAL) list of columns to read, default is all columns.
+        :param filters: (OPTIONAL) list of filters to apply when reading in the form [('column', '==', value)].
+        :return: pandas dataframe
+        """
+        df = pd.read_parquet(filelocation, engine='pyarrow', columns=columns, filters=filters)
+        self.logger.info('{} read to dataframe.'.format(filelocation))
+        return df
+
+    def read_arrow_pickle(self, filelocation):
+        """
+        This function reads a dataframe saved with WriteData.dump_arrow_pickle() from file to df.
+        The file is read in one go and the data buffers are handed to pickle as slices of it, so the column data is
+        not copied again while unpickling.
+
+        :param filelocation: full path to the file location of the arrow pickle file.
+        :return: pandas dataframe
+        """
+        with open(filelocation, 'rb') as f:
+            content = memoryview(f.read())
+        # The first frame holds the number of data buffers, then the pickle data and the buffers follow:
+        number_buffers, = struct.unpack_from('<Q', content)
+        offset = 8
+        frames = []
+        for _ in range(number_buffers + 1):
+            size, = struct.unpack_from('<Q', content, offset)
+            offset += 8
+            frames.append(content[offset:offset + size])
+            offset += size
+        table = pickle.loads(frames[0], buffers=frames[1:])
+        df = table.to_pandas()
+        self.logger.info('{} read to dataframe.'.format(filelocation))
+        return df
+
     def read_zip_to_df(self, filelocation):
         """
-        This function unpacks a zipfile and checks the extension to determine whether it should read it to a dataframe
-        as csv/xlsx/pk1.
-        It then removes the unpacked file again.
+        This function reads the file inside a zipfile and checks the extension to determine whether it should read it to
+        a dataframe as csv/xlsx/parquet/pk1.
+        The file is read straight from the zipfile, it is not unpacked to disk first.
 
         NOTE: it assumes default settings when reading files. So, comma-separated csv and sheet0 for an excel file.
         If you have different settings or multiple sheets, unpack the zipfile in your own script first and then call
@@ -66,7 +165,6 @@ class ReadData:
         :param filelocation: full path to the file location of the csv-file.
         :return: pandas dataframe
         """
-        # Unpack to current workdirectory:
         with zipfile.ZipFile(filelocation, 'r') as zp:
             # Get filename of the file in the zip:
             if len(zp.namelist()) == 1:
@@ -74,21 +172,21 @@ class ReadData:
             else:
                 self.logger.error('Zipfile {} contains multiple files, cannot be used here.'.format(filelocation))
                 exit()
-            zp.extractall(os.getcwd())
-        # Check the extension of the filename to see which one should be used to read it to a dataframe:
-        extension = filename.split('.')[-1]
-        fileloc = '{}/{}'.format(os.getcwd(), filename)
-        if extension == 'csv':
-            df = self.read_csv_to_df(fileloc)
-        elif extension == 'xlsx':
-            df = self.read_excel_to_df(fileloc)
-        elif extension == 'pk1':
-            df = self.read_pickle_to_df(fileloc)
-        else:
-            self.logger.error('Filetype {} not supported.'.format(extension))
-            df = None
-        # Remove unpacked file:
-        os.remove(fileloc)
+            # Check the extension of the filename to see which one should be used to read it to a dataframe:
+            extension = filename.split('.')[-1]
+            with zp.open(filename) as fh:
+                if extension == 'csv':
+                    df = self.read_csv_to_df(fh)
+                elif extension == 'xlsx':
+                    # Excel and parquet files need random access, read them to memory first:
+                    df = self.read_excel_to_df(io.BytesIO(fh.read()))
+                elif extension == 'parquet':
+                    df = self.read_parquet_to_df(io.BytesIO(fh.read()))
+                elif extension == 'pk1':
+                    df = self.read_pickle_to_df(fh)
+                else:
+                    self.logger.error('Filetype {} not supported.'.format(extension))
+                    df = None
         return df
 
     def read_excel_to_df(self, filelocation, sheet_number=0, skiprows=0):
@@ -112,7 +210,7 @@ class ReadData:
         """
         This function reads an sql file to a variable so that it can be run with for example
         Teradata.retrieve_dataframe().
-        It reads the file line by line and returns a string variable of the query.
+        It reads the file and returns a string variable of the query.
         The function can also replace values in the query using a dictionary. This is useful if the query date needs
         to be changed dynamically for example. Given the dictionary:
         dict = { '01-01-1900': '01-01-2018' }
@@ -123,11 +221,10 @@ class ReadData:
         :param replace_dict: a dictionary of keys in the query that need to be replaced with another value (OPTIONAL)
         :return: SQL string query
         """
-        sql = ''''''
         with open(filelocation, 'r') as f:
-            for line in f:
-                sql = sql + line
-        # Replace all values in the query that need to be replaced:
+            sql = f.read()
+        # Replace all values in the query that need to be replaced, one key after the other in the order of the
+        # dictionary (so a replaced value can contain a key that is replaced later on):
         if replace_dict is not None:
             for key in replace_dict:
                 sql = sql.replace(key, replace_dict[key])
@@ -152,77 +249,193 @@ class WriteData:
         :param dpi: (OPTIONAL, default=300) the dpi to use for saving the image.
         """
         fig.savefig(location, dpi=dpi)
-        plt.close()  # close the fig so it doesn't interfere with potential subsequent plots
+        plt.close(fig)  # close the fig so it doesn't interfere with potential subsequent plots
         self.logger.info('Plot saved to {}'.format(location))
 
     def list_to_textfile(self, input_list, location):
         """
-        This function writes a list to textfile. It loops through all entries in the [input_list] and writes them to the
-        textfile which is saved at  [location].
+        This function writes a list to textfile. It writes all entries in the [input_list] to the textfile which is
+        saved at [location]. The entries are written as they are, so add a newline to entries that should end a line.
 
         :param input_list: a list of strings to write to file
         :param location: full path where to save the textfile
         """
         with open(location, 'w') as f:
-            for i in input_list:
-                f.write(i)
-        f.close()
+            f.writelines(input_list)
         self.logger.info('Data from list written to {}'.format(location))
 
-    def save_df(self, df, location, name, sort_by=None, split_by=None, filetype='csv'):
+    def dump_arrow_pickle(self, df, location):
+        """
+        This function saves a dataframe to file as a pickled Arrow table (pickle protocol 5). The column data is not
+        copied into the pickle but handed over as separate buffers, which are written to the file directly after it.
+        This makes saving and reading (ReadData.read_arrow_pickle()) much faster than pickling the dataframe itself,
+        use it for caching large dataframes. The index is not saved.
+
+        The file consists of frames that are each prefixed with their length: the number of buffers, the pickle data
+        and then the data buffers.
+
+        :param df: the dataframe to be saved
+        :param location: full path where to save the file
         """
-        This function saves a pandas dataframe to a csv/xlsx/pk1 file. It can optionally sort the dataframe before
-        exporting. It can also split the dataframe by a column before exporting and export a single file per column
-        level. If exporting by column level, the complete file will also be written. Index is not written (unless
+        import pyarrow as pa
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        buffers = []
+        data = pickle.dumps(table, protocol=5, buffer_callback=buffers.append)
+        with open(location, 'wb') as f:
+            f.write(struct.pack('<Q', len(buffers)))
+            for frame in [data] + [buffer.raw() for buffer in buffers]:
+                f.write(struct.pack('<Q', len(frame)))  # raw() gives a flat byte view, so len() is the size
+                f.write(frame)
+        self.logger.info('Dataframe written to {}'.format(location))
+
+    def save_df(self, df, location, name, sort_by=None, split_by=None, filetype='csv', csv_engine=None):
+        """
+        This function saves a pandas dataframe to a csv/xlsx/parquet/pk1 file. It can optionally sort the dataframe
+        before exporting. It can also split the dataframe by a column before exporting and export a single file per
+        column level. If exporting by column level, the complete file will also be written. Index is not written (unless
         filetype = pk1).
 
-        Note that when reading/writing, pk1 files are much faster.
+        Note that when reading/writing, parquet files are much faster and smaller (zstd compressed). The pk1 filetype
+        is deprecated and only kept for existing scripts.
 
         :param df: the dataframe to be saved
         :param location: the location on the disk where to save the file (full path)
         :param name: the name to use for the file without file extension (so no .csv)
         :param sort_by: (OPTIONAL) by which column the dataframe needs to be sorted before saving
         :param split_by: (OPTIONAL) the dataframe will be split by this column and a separate csv file will be created
-        :param filetype: (OPTIONAL) which file type needs to be saved, 'csv', 'xlsx' or 'pk1', default = csv.
+        :param filetype: (OPTIONAL) which file type needs to be saved, 'csv', 'xlsx', 'parquet' or 'pk1',
+         default = csv.
          for each level of the column. The name will be appended by the level.
+        :param csv_engine: (OPTIONAL) the csv writer to use, None (pandas, default) or 'pyarrow', see _write_csv().
         """
-        filetypes = ['csv', 'xlsx', 'pk1']
+        filetypes = ['csv', 'xlsx', 'parquet', 'pk1']
         if filetype in filetypes:
             if sort_by is not None:
                 df.sort_values(by=[sort_by], inplace=True)
             if filetype == 'csv':
-                df.to_csv('{}/{}.csv'.format(location, name), index=False)
+                self._write_csv(df, '{}/{}.csv'.format(location, name), csv_engine)
             elif filetype == 'xlsx':
-                writer = pd.ExcelWriter('{}/{}.xlsx'.format(location, name), engine='xlsxwriter')
-                df.to_excel(writer, sheet_name='Sheet1', index=False)  # send df to writer
-                worksheet = writer.sheets['Sheet1']  # pull worksheet object
-                for idx, col in enumerate(df):  # loop through all columns
-                    series = df[col]
-                    if isinstance(series, pd.Series):
-                        max_len = max((
-                            series.astype(str).map(len).max(),  # len of largest item
-                            len(str(series.name))  # len of column name/header
-                        )) + 1  # adding a little extra space
-                    else:
-                        max_len = 100
-                    # Set the maximum width to 100 to prevent excessive wide columns:
-                    if max_len > 100:
-                        max_len = 100
-                    worksheet.set_column(idx, idx, max_len)  # set column width
-                writer.save()
-            if split_by is not None:
-                values = df[split_by].unique().tolist()
-                for value in values:
-                    subdf = df[(df[split_by] == value)]  # subset df for column level
-                    savename = '{0}/{1}_{2}.'.format(location, name, value)
-                    if filetype == 'csv':
-                        subdf.to_csv(savename + filetype, index=False)
-                    elif filetype == 'xlsx':
-                        subdf.to_excel(savename + filetype, index=False)
+                self._write_excel(df, '{}/{}.xlsx'.format(location, name))
+            elif filetype == 'parquet':
+                df.to_parquet('{}/{}.parquet'.format(location, name), engine='pyarrow', compression='zstd',
+                              index=False)
             elif filetype == 'pk1':
+                self.logger.warning('Pickle (pk1) files are deprecated, use filetype parquet instead.')
                 df.to_pickle('{}/{}.pk1'.format(location, name))
+            if split_by is not None:
+                # Split the df in a single pass and write the files for the column levels in parallel, rows without
+                # a value are written to the '_nan' file. Unused categories of a categorical column get no file:
+                groups = df.groupby(split_by, sort=False, dropna=False, observed=True)
+                with ThreadPoolExecutor() as executor:
+                    futures = [executor.submit(self.save_split_level, subdf,
+                                               '{0}/{1}_{2}.{3}'.format(location, name, value, filetype), filetype,
+                                               csv_engine)
+                               for value, subdf in groups]
+                for future in futures:
+                    future.result()  # raise the error if writing a file failed
         else:
-            self.logger.error("Filetype '{}' currently not supported, choose csv, xlsx or pk1.".format(filetype))
+            self.logger.error("Filetype '{}' currently not supported, choose csv, xlsx, parquet or pk1."
+                              .format(filetype))
+
+    def save_df_to_buffer(self, df, filetype='csv', csv_engine=None):
+        """
+        This function saves a pandas dataframe to a csv/xlsx/parquet/pk1 file in memory instead of on disk, for example
+        to send it on directly. The file content is the same as save_df() writes to disk. Index is not written (unless
+        filetype = pk1).
+
+        :param df: the dataframe to be saved
+        :param filetype: (OPTIONAL) which file type needs to be saved, 'csv', 'xlsx', 'parquet' or 'pk1',
+         default = csv.
+        :param csv_engine: (OPTIONAL) the csv writer to use, None (pandas, default) or 'pyarrow', see _write_csv().
+        :return: io.BytesIO buffer holding the file, positioned at the start (None if the filetype is not supported).
+        """
+        buffer = io.BytesIO()
+        if filetype == 'csv':
+            self._write_csv(df, buffer, csv_engine)
+        elif filetype == 'xlsx':
+            self._write_excel(df, buffer)
+        elif filetype == 'parquet':
+            df.to_parquet(buffer, engine='pyarrow', compression='zstd', index=False)
+        elif filetype == 'pk1':
+            df.to_pickle(buffer)
+        else:
+            self.logger.error("Filetype '{}' currently not supported, choose csv, xlsx, parquet or pk1."
+                              .format(filetype))
+            return None
+        buffer.seek(0)
+        return buffer
+
+    @staticmethod
+    def _write_excel(df, target):
+        """
+        Helper function to write a dataframe to an excel file without the index. The widths of the columns are set to
+        fit the content.
+
+        :param df: the dataframe to be saved
+        :param target: full path of the excel file to save or a file-like object to write to
+        """
+        writer = pd.ExcelWriter(target, engine='xlsxwriter')
+        df.to_excel(writer, sheet_name='Sheet1', index=False)  # send df to writer
+        worksheet = writer.sheets['Sheet1']  # pull worksheet object
+        # Estimate the column widths from the first rows, measuring every value takes long for large dfs:
+        sample = df.head(1000)
+        for idx, col in enumerate(df):  # loop through all columns
+            # Select by position, so duplicate column names also give a single column:
+            series = sample.iloc[:, idx]
+            max_len = max((
+                series.astype(str).map(len).max() if len(series) else 0,  # len of largest item
+                len(str(col))  # len of column name/header
+            )) + 1  # adding a little extra space
+            # Set the maximum width to 100 to prevent excessive wide columns:
+            if max_len > 100:
+                max_len = 100
+            worksheet.set_column(idx, idx, max_len)  # set column width
+        writer.save()
+
+    @staticmethod
+    def _write_csv(df, savename, engine=None):
+        """
+        Helper function to write a dataframe to csv without the index. By default it is written by pandas.
+
+        With engine='pyarrow', dataframes with only numeric columns are written with the multi-threaded pyarrow csv
+        writer, which is much faster than pandas. The content is the same, but the format is not: pyarrow quotes the
+        header ("a","b") and writes whole floats without decimals (1 instead of 1.0), so those columns are read back
+        as integers. Other dataframes (or without pyarrow installed) are always written with pandas.
+
+        :param df: the dataframe to be saved
+        :param savename: full path of the csv file to save or a binary file-like object to write to
+        :param engine: (OPTIONAL) None (pandas, default) or 'pyarrow'.
+        """
+        if engine == 'pyarrow' and len(df.columns) and all(dtype.kind in 'iuf' for dtype in df.dtypes):
+            try:
+                import pyarrow as pa
+                from pyarrow import csv as pacsv
+            except ImportError:
+                pass
+            else:
+                pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), savename)
+                return
+        df.to_csv(savename, index=False)
+
+    @staticmethod
+    def save_split_level(df, savename, filetype, csv_engine=None):
+        """
+        Helper function for save_df() to save the part of the dataframe for a single column level.
+
+        :param df: the part of the dataframe to be saved
+        :param savename: full path of the file to save including extension
+        :param filetype: which file type needs to be saved, 'csv', 'xlsx', 'parquet' or 'pk1'.
+        :param csv_engine: (OPTIONAL) the csv writer to use, None (pandas, default) or 'pyarrow', see _write_csv().
+        """
+        if filetype == 'csv':
+            WriteData._write_csv(df, savename, csv_engine)
+        elif filetype == 'xlsx':
+            df.to_excel(savename, index=False)
+        elif filetype == 'parquet':
+            df.to_parquet(savename, engine='pyarrow', compression='zstd', index=False)
+        elif filetype == 'pk1':
+            df.to_pickle(savename)
 
 
 class SQL:
@@ -268,6 +481,23 @@ class SQL:
         df = pd.read_sql(sql_query, self.con)
         return df
 
+    def retrieve_dataframe_chunks(self, sql_query, chunksize=100000):
+        """
+        This function runs the given sql_query and yields the results as pandas dataframes of at most [chunksize] rows.
+        Only one chunk is kept in memory at a time, use it for query results that are too large to load at once, for
+        example to aggregate them or write them to file chunk by chunk:
+
+        for df in td.retrieve_dataframe_chunks(sql_query):
+            wd.save_df(df, ...)
+
+        :param sql_query: an SQL query string in the form "select * from DB where x = 5;"
+        :param chunksize: (OPTIONAL) the maximum number of rows per dataframe (default=100000)
+        :return: generator of pandas dataframes containing the results of the query
+        """
+        self.logger.info('Loading data to pandas dataframes of {} rows using the SQL query: "{}"'.format(chunksize,
+                                                                                                        sql_query))
+        yield from pd.read_sql(sql_query, self.con, chunksize=chunksize)
+
 
 class Teradata(SQL):
     """
@@ -290,16 +520,18 @@ class Teradata(SQL):
     pd.set_option('display.max_columns', None)  # print all columns of dataframe
     pd.set_option('display.width', 1000)  # use more width of the screen when printing dataframes
 
+    # The driver found by the first connection, later connections reuse it:
+    _cached_driver = None
+
     def __init__(self, host_name, uid, pwd, driver_name=None, loglevel='INFO'):
         self.logger = Logger('DataAccess.Teradata', loglevel).logger
 
         if driver_name is None:
-            # Find the Teradata driver installed
-            driver_list = self.pyodbc.drivers()
-            teradata_drivers = [i for i in driver_list if 'Teradata' in i]
-            if len(teradata_drivers) != 0:
-                driver_name = teradata_drivers[0]  # simply take the first drivername
-            else:
+            if Teradata._cached_driver is None:
+                # Find the Teradata driver installed, simply take the first drivername:
+                Teradata._cached_driver = next((i for i in self.pyodbc.drivers() if 'Teradata' in i), None)
+            driver_name = Teradata._cached_driver
+            if driver_name is None:
                 self.logger.error('No Teradata driver found. Install the ODBC driver for Windows first.')
                 self.logger.error('https://downloads.teradata.com/download/connectivity/odbc-driver/windows')
                 exit(1)
@@ -329,16 +561,19 @@ class Postgres(SQL):
     pd.set_option('display.max_columns', None)  # print all columns of dataframe
     pd.set_option('display.width', 1000)  # use more width of the screen when printing dataframes
 
+    # The driver found by the first connection, later connections reuse it:
+    _cached_driver = None
+
     def __init__(self, host_name, uid, pwd, database, driver_name=None, loglevel='INFO'):
         self.logger = Logger('DataAccess.Postgres', loglevel).logger
 
         if driver_name is None:
-            # Find the Teradata driver installed
-            driver_list = self.pyodbc.drivers()
-            drivers = [i for i in driver_list if 'PostgreSQL ODBC Driver(UNICODE)' in i]
-            if len(drivers) != 0:
-                driver_name = drivers[0]  # simply take the first drivername
-            else:
+            if Postgres._cached_driver is None:
+                # Find the PostgreSQL driver installed, simply take the first drivername:
+                Postgres._cached_driver = next((i for i in self.pyodbc.drivers()
+                                                if 'PostgreSQL ODBC Driver(UNICODE)' in i), None)
+            driver_name = Postgres._cached_driver
+            if driver_name is None:
                 self.logger.error('PostgreSQL ODBC Driver(UNICODE) driver not found. Install the ODBC driver for '
                                   'Windows first.')
                 exit(1)
@@ -382,11 +617,35 @@ class Postgres(SQL):
         :param postgis: whether to send a geopandas dataframe (with geometry) or not (default=False).
         """
         if not postgis:
-            df.to_sql(tablename, self.engine, schema=schema_name, if_exists=mode, index=False)
+            # Let to_sql create the table if needed but load the rows with COPY instead of INSERT statements:
+            df.to_sql(tablename, self.engine, schema=schema_name, if_exists=mode, index=False,
+                      method=self._psql_insert_copy)
         else:
             df.to_postgis(tablename, self.engine, schema=schema_name, if_exists=mode, index=False)
         self.logger.info('Dataframe was send to the database. Schema={}, table={}'.format(schema_name, tablename))
 
+    @staticmethod
+    def _psql_insert_copy(table, conn, keys, data_iter):
+        """
+        Insert method for DataFrame.to_sql() that loads the rows with a single COPY ... FROM STDIN, which is much
+        faster than inserting the rows with INSERT statements.
+
+        :param table: pandas SQLTable of the table to load
+        :param conn: sqlalchemy connection
+        :param keys: list of column names
+        :param data_iter: iterable with the rows to load
+        """
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(data_iter)
+        buffer.seek(0)
+        columns = ', '.join('"{}"'.format(key) for key in keys)
+        if table.schema:
+            table_name = '"{}"."{}"'.format(table.schema, table.name)
+        else:
+            table_name = '"{}"'.format(table.name)
+        with conn.connection.cursor() as cur:
+            cur.copy_expert('COPY {} ({}) FROM STDIN WITH CSV'.format(table_name, columns), buffer)
+
     def create_database(self, db_name):
         """
         This function drops a database if it exists. Then, it creates the database.
@@ -424,8 +683,46 @@ class SharePoint:
         # Set the proxy settings to use:
         proxy_string = 'http://{}:{}@10.11.24.70:8080'.format(username, password)
         self.proxies = {'https': proxy_string}
+        # Reuse the connections for all requests, with enough connections for the parallel requests:
+        self.session = self.requests.Session()
+        adapter = self.requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=16)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # Whether to connect through the proxy, switched off once the proxy can not be reached:
+        self.use_proxy = True
+
+    def _get(self, url, **kwargs):
+        """
+        Helper function that sends a GET request over the session. It connects through the proxy, which is needed at
+        location (in the company). If the proxy can not be reached (outside the company on the VPN), it connects
+        directly instead and keeps doing so for the next requests.
+
+        :param url: the url to retrieve
+        :param kwargs: other arguments passed on to the request
+        :return: the response
+        """
+        if self.use_proxy:
+            try:
+                return self.session.get(url, proxies=self.proxies, **kwargs)
+            except self.requests.exceptions.ConnectionError as ex:
+                # Includes ProxyError and ConnectTimeout:
+                self.logger.info('Proxy connection failed ({}), connecting directly.'.format(ex))
+                self.use_proxy = False
+        return self.session.get(url, **kwargs)
+
+    @staticmethod
+    def _file_change_time(resp):
+        """
+        Helper function that gets the modification date of the retrieved file and converts it to local time.
+
+        :param resp: the response of the request for the file
+        :return: the modification date/time as a datetime object
+        """
+        change_utc = datetime.strptime(resp.headers['moddate'], '%Y-%m-%dT%H:%M:%SZ')
+        offset = datetime.fromtimestamp(time.time()) - datetime.utcfromtimestamp(time.time())
+        return change_utc + offset
 
-    def retrieve_sp_list(self, current_min=0):
+    def retrieve_sp_list(self, current_min=0, workers=8):
         """
         This function retrieves all data from a SharePoint list and returns it as a list of dictionaries.
         It retrieves the data in blocks of 100 entries, starting from ID=0 and ending when no new entries are found.
@@ -436,10 +733,15 @@ class SharePoint:
         results have been found, it will stop when no new results are retrieved in a call.
         A safeguard has been built in to prevent an endless loop, if the first 25 calls give no results, it will quite.
 
+        The blocks are retrieved [workers] at a time in parallel, the results are processed in order of the blocks.
+        Blocks after the block where the retrieval stops are ignored, so the result is the same as retrieving the
+        blocks one by one.
+
         WARNING!: If there is a gap in the list data of more than 100 entries, not all data will be retrieved!
         For example, if you have IDs 200-1000 and 1200-2500, only IDs 200-1000 will be retrieved.
 
         :param current_min: can be used to start from a different id than 0.
+        :param workers: (OPTIONAL) the number of blocks to retrieve in parallel (default=8, max 16).
         :return: the SharePoint list data as a list of dictionaries
         """
         entries = []
@@ -447,25 +749,33 @@ class SharePoint:
         retrieve = True
         failures = 0
         min_id = current_min
-        while retrieve:
-            current_max = current_min + 101  # set max to 101 entries higher so that it retrieves 100 entries
-            entries = entries + self.retrieve_sp_list_data(current_min, current_max)  # add the entries to the save list
-            if number_results != 0 and number_results == len(entries):
-                # If no new results are retrieved anymore, break the while loop.
-                retrieve = False
-            # Here a bit of code to prevent an endless loop in case of an empty list:
-            if len(entries) == 0:
-                # Set the min_id to the current_max - 1 so make sure it knows where to start next time.
-                min_id = current_max - 1
-                failures += 1
-            if failures == 25:
-                retrieve = False
-            # Get the number of results:
-            number_results = len(entries)
-            self.logger.info('Processed ID-range {}:{}, total entries retrieved so far: {}'.format(current_min,
-                                                                                                   current_max,
-                                                                                                   number_results))
-            current_min = current_max - 1  # update current minimum, the -1 prevents skipping one
+        # The session has 16 connections (see __init__), more parallel requests would only wait for a connection:
+        workers = min(workers, 16)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while retrieve:
+                # Set max to 101 entries higher than min so that it retrieves 100 entries per block, the -1 between the
+                # blocks prevents skipping one:
+                id_ranges = [(current_min + i * 100, current_min + i * 100 + 101) for i in range(workers)]
+                blocks = executor.map(lambda id_range: self.retrieve_sp_list_data(*id_range), id_ranges)
+                for (current_min, current_max), block in zip(id_ranges, blocks):
+                    entries.extend(block)  # add the entries to the save list
+                    if number_results != 0 and number_results == len(entries):
+                        # If no new results are retrieved anymore, break the while loop.
+                        retrieve = False
+                    # Here a bit of code to prevent an endless loop in case of an empty list:
+                    if len(entries) == 0:
+                        # Set the min_id to the current_max - 1 so make sure it knows where to start next time.
+                        min_id = current_max - 1
+                        failures += 1
+                    if failures == 25:
+                        retrieve = False
+                    # Get the number of results:
+                    number_results = len(entries)
+                    self.logger.info('Processed ID-range {}:{}, total entries retrieved so far: {}'.format(
+                        current_min, current_max, number_results))
+                    if not retrieve:
+                        break
+                current_min = current_max - 1  # update current minimum, the -1 prevents skipping one
         return entries, min_id
 
     def retrieve_sp_list_data(self, min_id, max_id):
@@ -483,52 +793,44 @@ class SharePoint:
         url = url.replace('{clientSecret}', self.client_secret)
         url = url.replace('{min_id}', str(min_id))
         url = url.replace('{max_id}', str(max_id))
-        try:
-            # This needs to run when at location (in the company)
-            resp = self.requests.get(url, proxies=self.proxies)
-        except Exception:
-            # This needs to run when outside the company on the VPN
-            resp = self.requests.get(url)
+        resp = self._get(url)
         results = []
         if resp.status_code == 200:  # get status code, 200 is successfull
-            # The returned results are given as a list of dictionaries but need to be evaluated as such
-            res = resp.text.replace('null', '""')  # This line replaces null values with an empty string, else error
-            results = eval(res)
+            # The returned results are given as a JSON list of dictionaries, null values are replaced by empty strings:
+            results = json.loads(resp.content, object_hook=_null_to_empty_string)
         else:
             self.logger.error('Get failed, code = {}'.format(resp.status_code))
         return results
 
     def retrieve_sp_excelfile(self, sheets):
         """
-        This function retrieves a sharepoint excel file from sharepoint. It stores it temporarily as excel on the disk
-        in the current working directory, reads the file again with pandas, removes the temporary excel file again, then
-        it returns the pandas dataframe.
+        This function retrieves a sharepoint excel file from sharepoint. It downloads the file to memory, reads the
+        requested sheets from it with pandas and returns the pandas dataframes. The excel file is only opened once for
+        all sheets and nothing is written to disk.
 
         :param sheets: a list of tuples with (sheetname, skiprows) where skiprows is the number of rows to skip
          before reading the header.
         :return: a list of pandas dataframes with the data from the sharepoint excel, 1 df per sheet in the excel.
         """
-        # Set the filepath for the temp save location:
-        temp_file_loc = os.getcwd() + '/temp.xlsx'
+        # Replace the values for client_id and client_secret in the URL:
+        url = self.url.replace('{clientID}', self.client_id)
+        url = url.replace('{clientSecret}', self.client_secret)
         # Retrieve the file:
-        status_code, change_dt = self.retrieve_file(temp_file_loc)
+        resp = self._get(url)
         # Check response code:
-        if status_code == 200:  # successfull
+        if resp.status_code == 200:  # successfull
+            change_dt = self._file_change_time(resp).strftime('%d/%m/%Y %H:%M')
             # Read the excel file to a pandas df (one for each sheet):
             df_list = []
-            for sheet, skip in sheets:
-                df = pd.read_excel(temp_file_loc, sheet_name=sheet, skiprows=skip)
-                # Drop empty rows and columns (only if a row or column only contains NA):
-                df.dropna(how='all', axis=1, inplace=True)
-                df.dropna(how='all', axis=0, inplace=True)
-                df_list.append(df)
-            # Remove the temporary file again:
-            try:
-                os.remove(temp_file_loc)
-            except Exception as ex:
-                self.logger.error('Error removing temp file again: {}'.format(ex))
+            with pd.ExcelFile(io.BytesIO(resp.content)) as excel_file:
+                for sheet, skip in sheets:
+                    df = excel_file.parse(sheet_name=sheet, skiprows=skip)
+                    # Drop empty rows and columns (only if a row or column only contains NA):
+                    df.dropna(how='all', axis=1, inplace=True)
+                    df.dropna(how='all', axis=0, inplace=True)
+                    df_list.append(df)
         else:
-            self.logger.error('Get failed, code = {}'.format(status_code))
+            self.logger.error('Get failed, code = {}'.format(resp.status_code))
             df_list, change_dt = None, None  # Set return_val to None
         return df_list, change_dt
 
@@ -548,24 +850,19 @@ class SharePoint:
         url = url.replace('{clientSecret}', self.client_secret)
         if filename is not None:
             url = url.replace('{fileName}', filename)
-        # Retrieve the excelfile from sharepoint:
-        try:
-            resp = self.requests.get(url, proxies=self.proxies)
-        except Exception:
-            resp = self.requests.get(url)
-        # Check response code:
-        if resp.status_code == 200:  # successfull
-            # Get the modification date of the file and then convert to local time:
-            change_utc = datetime.strptime(resp.headers['moddate'], '%Y-%m-%dT%H:%M:%SZ')
-            offset = datetime.fromtimestamp(time.time()) - datetime.utcfromtimestamp(time.time())
-            file_change = (change_utc + offset).strftime('%d/%m/%Y %H:%M')
-            # Write the data to an temporary excel:
-            with open(filepath, "wb") as f:
-                f.write(resp.content)
-            f.close()
-        else:
-            self.logger.error('Get failed, code = {}'.format(resp.status_code))
-            file_change = None
+        # Retrieve the excelfile from sharepoint, the content is only downloaded while writing it to disk:
+        resp = self._get(url, stream=True)
+        with resp:
+            # Check response code:
+            if resp.status_code == 200:  # successfull
+                file_change = self._file_change_time(resp).strftime('%d/%m/%Y %H:%M')
+                # Write the data to disk in blocks of 1 MB, so the file is never completely in memory:
+                with open(filepath, "wb") as f:
+                    for block in resp.iter_content(chunk_size=1 << 20):
+                        f.write(block)
+            else:
+                self.logger.error('Get failed, code = {}'.format(resp.status_code))
+                file_change = None
         return resp.status_code, file_change
 
     def retrieve_sp_updatetime(self, filename):
@@ -580,16 +877,10 @@ class SharePoint:
         url = self.url.replace('{clientID}', self.client_id)
         url = url.replace('{clientSecret}', self.client_secret)
         url = url.replace('{fileName}', filename)
-        try:
-            resp = self.requests.get(url, proxies=self.proxies)
-        except Exception:
-            resp = self.requests.get(url)
+        resp = self._get(url)
         # Check response code:
         if resp.status_code == 200:  # successfull
-            # Get the modification date of the file and then convert to local time:
-            change_utc = datetime.strptime(resp.headers['moddate'], '%Y-%m-%dT%H:%M:%SZ')
-            offset = datetime.fromtimestamp(time.time()) - datetime.utcfromtimestamp(time.time())
-            file_change = (change_utc + offset)
+            file_change = self._file_change_time(resp)
         else:
             self.logger.error('Get failed, code = {}'.format(resp.status_code))
             file_change = None
@@ -605,11 +896,15 @@ class SendData:
     It also needs the CWID username and password (used for windows) in order to also function properly when working
     from within the company network.
 
+    If the MS Flow endpoint accepts zstd compressed requests, set zstd_level to compress the files before sending
+    them (Content-Encoding: zstd). Levels 1-5 are fast enough to not slow down sending, higher levels give smaller
+    requests but take longer. This needs the zstandard package.
+
     """
     # Optional library support modules (aka: only needed for this class):
     import requests
 
-    def __init__(self, url, client_id, client_secret, username, password, loglevel='INFO'):
+    def __init__(self, url, client_id, client_secret, username, password, loglevel='INFO', zstd_level=None):
         self.logger = Logger('DataAccess.Sharepoint', loglevel).logger
         self.url = url
         self.client_id = client_id
@@ -617,6 +912,13 @@ class SendData:
         # Set the proxy settings to use:
         proxy_string = 'http://{}:{}@10.11.24.70:8080'.format(username, password)
         self.proxies = {'https': proxy_string}
+        # Compression level for the send data, None sends the data uncompressed:
+        self.zstd_level = zstd_level
+        # Reuse the connections for all requests, with enough connections for the parallel uploads:
+        self.session = self.requests.Session()
+        adapter = self.requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=8)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         # Initiate the WriteData class:
         self.wd = WriteData(loglevel=loglevel)
 
@@ -628,11 +930,37 @@ class SendData:
         It uses 'filename' as the filename, therefore, the filename in the filepath doesn't need to be the same
         as the one in 'filename'.
 
+        The file is streamed in chunks while sending, so also files larger than the available memory can be send.
+
         :param filepath: the full path to the file to be read / send.
         :param filename: how the attached file should be called including extension (Datafile.xlsx).
         """
-        # First read the file:
-        data = open(filepath, 'rb').read()
+        with open(filepath, 'rb') as f:
+            self.data_to_msflow(f, filename)
+
+    def batch_files_to_msflow(self, files, workers=4):
+        """
+        This function sends multiple files to MS Flow using file_to_msflow(). The files are send in parallel, which is
+        much faster than sending them one by one as most of the time is spent waiting for MS Flow.
+
+        :param files: a list of tuples with (filepath, filename), see file_to_msflow().
+        :param workers: (OPTIONAL) the number of files to send at the same time (default=4, max 8).
+        """
+        # The session has 8 connections (see __init__), more parallel requests would only wait for a connection:
+        with ThreadPoolExecutor(max_workers=min(workers, 8)) as executor:
+            futures = [executor.submit(self.file_to_msflow, filepath, filename) for filepath, filename in files]
+        for future in futures:
+            future.result()  # raise the error if sending a file failed
+
+    def data_to_msflow(self, data, filename):
+        """
+        This function sends the content of a file (bytes) to MS Flow using a POST request, see file_to_msflow().
+        Use it to send files that were created in memory, without saving them to disk first.
+        A file object (opened with 'rb') is streamed from the start of the file instead.
+
+        :param data: the content of the file to send (bytes) or a file object.
+        :param filename: how the attached file should be called including extension (Datafile.xlsx).
+        """
         if self.client_id is None:
             self.logger.error('Cannot connect to sharepoint because client_id is empty.')
         if self.client_secret is None:
@@ -644,61 +972,106 @@ class SendData:
         url = url.replace('{clientSecret}', self.client_secret)
         # Replace the 'fileContent' with the base64 encoded excel file:
         url = url.replace('{fileName}', filename)
+        headers = {}
+        if self.zstd_level is not None:
+            headers['Content-Encoding'] = 'zstd'
         try:
-            resp = self.requests.post(url, data, proxies=self.proxies)
+            resp = self.session.post(url, self._request_body(data), headers=headers, proxies=self.proxies)
         except Exception:
-            resp = self.requests.post(url, data)
+            # The body has to be created again, a streamed file may already be (partly) read:
+            resp = self.session.post(url, self._request_body(data), headers=headers)
         if resp.status_code == 200:  # get status code, 200 is successfull
             self.logger.info('File to SharePoint request accepted, file {} has been send.'.format(filename))
         else:
             self.logger.error('Sending file to SharePoint failed, code = {}'.format(resp.status_code))
 
+    def _request_body(self, data):
+        """
+        This function returns the body of the POST request for data_to_msflow(), compressed if zstd_level is set.
+        A file object is read from the start of the file and compressed in chunks of 1 MB while sending.
+
+        :param data: the content of the file to send (bytes) or a file object.
+        :return: the request body (bytes, file object or an iterator of compressed chunks)
+        """
+        if hasattr(data, 'seek'):
+            data.seek(0)
+        if self.zstd_level is None:
+            return data
+        import zstandard
+
+        compressor = zstandard.ZstdCompressor(level=self.zstd_level, threads=-1)
+        if hasattr(data, 'read'):
+            return compressor.read_to_iter(data, read_size=1 << 20)
+        return compressor.compress(data)
+
     def df_to_msflow(self, df, filename, zipit=False):
         """
-        This function first saves a df to a tempfile locally and then sends it to msflow including the filename.
-        It can process 'csv', 'xlsx' or 'pk1' files.
+        This function saves a df to a file in memory and then sends it to msflow including the filename.
+        It can process 'csv', 'xlsx', 'parquet' or 'pk1' files.
 
         :param df: the dataframe to send to MS Flow
         :param filename: the filename it should have in MS Flow (output.xlsx)
         :param zipit: True/False, if True it will zip the file and then send it to MS Flow.
         """
-        # Determine to which filetype it should be saved (xlsx, csv or pk1) based on the extension.
+        # Determine to which filetype it should be saved (xlsx, csv, parquet or pk1) based on the extension.
         extension = filename.split('.')[-1]
         basefilename = filename.split('.')[0]
-        if extension in ['xlsx', 'csv', 'pk1']:
+        if extension in ['xlsx', 'csv', 'parquet', 'pk1']:
             time0 = time.time()
-            self.wd.save_df(df, os.getcwd(), basefilename, filetype=extension)
-            self.logger.info('Time taken to save df temporary to disk = {} seconds.'.format(time.time() - time0))
-            tempfile_loc = os.getcwd() + '/' + basefilename + '.' + extension
+            data = self.wd.save_df_to_buffer(df, filetype=extension).getvalue()
+            self.logger.info('Time taken to save df to memory = {} seconds.'.format(time.time() - time0))
             if not zipit:
-                self.file_to_msflow(tempfile_loc, filename)
+                self.data_to_msflow(data, filename)
             else:
-                self.zip_to_msflow(tempfile_loc)
-            os.remove(tempfile_loc)
+                self.data_to_msflow(self.zip_data(data, basefilename + '.' + extension), basefilename + '.zip')
         else:
             self.logger.error('Filetype {} is not supported, exiting..'.format(extension))
             exit()
 
-    def zip_to_msflow(self, filepath):
+    @staticmethod
+    def zip_data(data, filename, level=1):
+        """
+        This function packs the content of a file (bytes) into a zip file in memory and returns the content of the zip
+        file. See zip_to_msflow() for the compression level.
+
+        :param data: the content of the file to zip (bytes).
+        :param filename: the filename of the file inside the zip file.
+        :param level: (OPTIONAL) the compression level from 1 (fastest) to 9 (smallest), default = 1.
+        :return: the content of the zip file (bytes)
         """
-        This function packs the file at the input 'filepath' into a zip file and then sends it to MS Flow using
-        file_to_msflow().
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=level) as zf:
+            zf.writestr(filename, data)
+        return buffer.getvalue()
+
+    def zip_to_msflow(self, filepath, level=1):
+        """
+        This function packs the file at the input 'filepath' into a zip file in memory and then sends it to MS Flow
+        using data_to_msflow(). No zip file is written to disk.
 
         The filename for the zipfile will be the same as the filename of the input 'filepath'.
 
+        The compression level sets the balance between speed and file size: 1 is fastest and compresses large exports
+        several times faster than the default level 6 for a slightly larger file, 9 gives the smallest file but is
+        slowest.
+
         :param filepath: the full path to the file to zip and send to MS flow.
+        :param level: (OPTIONAL) the compression level from 1 (fastest) to 9 (smallest), default = 1.
         """
-        # First get the basepath and filename from the full path:
-        basepath = os.path.dirname(filepath)
+        # First get the filename from the full path:
         filename = os.path.basename(filepath)
         # Get the basefilename (without extension):
         basefilename = filename.split('.')[0]
-        # Zip the file to reduce filesize to send:
-        zip_filename = basefilename + '.zip'
-        zipfilepath = '{}/{}'.format(basepath, zip_filename)
-        with zipfile.ZipFile(zipfilepath, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
-            zf.write(filepath, os.path.basename(filepath))
+        # Zip the file in memory to reduce filesize to send:
+        with open(filepath, 'rb') as f:
+            data = self.zip_data(f.read(), filename, level)
         # Send to SharePoint:
-        self.file_to_msflow(zipfilepath, zip_filename)
-        # Remove local zipfile again:
-        os.remove(zipfilepath)
+        self.data_to_msflow(data, basefilename + '.zip')
+
+
+def _null_to_empty_string(entry):
+    """
+    Object hook for json.loads() that replaces the null (None) values of a SharePoint list entry with an empty string.
+
+    """
+    return {key: '' if value is None else value for key, value in entry.items()}
@@ -2,9 +2,17 @@ import pandas as pd
 import numpy as np
 from datetime import datetime
 import collections
+import re
 # Own modules:
 from Logging import Logger
 
+# Strings that are considered empty, u"\u00A0" is to also include the 'NBSP' character (non breaking space):
+_EMPTY_ENTRIES = frozenset(['', ' ', 'N/A', u"\u00A0"])
+# The datestring formats supported by transform_date(): YYYY-MM-DDThh:mm:ssZ or MM/DD/YY(YY) and MM-DD-YY(YY), the
+# pattern has to match the complete datestring:
+_DATE_PATTERN = re.compile(r'(?P<iso_year>\d{4})-(?P<iso_month>\d{1,2})-(?P<iso_day>\d{1,2})T.*'
+                           r'|(?P<month>\d{1,2})(?P<sep>[/-])(?P<day>\d{1,2})(?P=sep)(?P<year>\d{2,4})')
+
 
 class HelperFunctions:
     """
@@ -23,17 +31,22 @@ class HelperFunctions:
         - NULL (np.nan, as checked using pd.isna())
         - ''
         - ' ' (only a space)
+        - 'N/A' and a non breaking space
 
         It returns True if the entry is empty, False otherwise.
 
         :return: True or False
         """
-        # u"\u00A0" is to also include the 'NBSP' character (non breaking space)
-        empty_list = ['', ' ', 'N/A', u"\u00A0"]
-        if entry not in empty_list and not pd.isna(entry):  # not empty
-            return False
-        else:
+        # Handle the common types directly, pd.isna() is relatively slow for single values:
+        if entry is None:
             return True
+        if isinstance(entry, str):
+            return entry in _EMPTY_ENTRIES
+        if isinstance(entry, float):
+            return entry != entry  # only NaN is not equal to itself
+        if isinstance(entry, int):
+            return False
+        return bool(pd.isna(entry))
 
     def replace_empty_entries(self, column_name, df):
         """
@@ -44,14 +57,11 @@ class HelperFunctions:
         :param column_name: the column to replace the empty values
         :return: a pandas dataframe with the column replaced.
         """
-        new_values = []
-        for row in df.itertuples(index=False):
-            value = row[df.columns.get_loc(column_name)]
-            if self.is_empty(value):
-                new_values.append(np.nan)
-            else:
-                new_values.append(value)
-        df[column_name] = new_values  # replace the column
+        column = df[column_name]
+        # Find the empty entries for the whole column at once:
+        empty = column.isna() | column.isin(_EMPTY_ENTRIES)
+        if empty.any():
+            df.loc[empty, column_name] = np.nan  # replace the empty values
 
         return df
 
@@ -65,7 +75,12 @@ class HelperFunctions:
         """
         out = None
         if type(stringdate) is str:
-            out = datetime.strptime(stringdate, '%m/%d/%Y')
+            # Slice the fixed MM/DD/YYYY layout directly, strptime has to interpret the format on every call:
+            if len(stringdate) == 10 and stringdate[2] == '/' and stringdate[5] == '/' and \
+                    (stringdate[0:2] + stringdate[3:5] + stringdate[6:10]).isdigit():
+                out = datetime(int(stringdate[6:10]), int(stringdate[0:2]), int(stringdate[3:5]))
+            else:
+                out = datetime.strptime(stringdate, '%m/%d/%Y')
         return out
 
     @staticmethod
@@ -78,9 +93,40 @@ class HelperFunctions:
         """
         out = None
         if dateobject is not None:
-            out = dateobject.strftime('%m/%d/%Y')
+            out = '{:02d}/{:02d}/{:04d}'.format(dateobject.month, dateobject.day, dateobject.year)
         return out
 
+    @staticmethod
+    def to_datetimes(datelist):
+        """
+        This function converts a list of datestrings (MM/DD/YYYY) to a pandas series of dates in one go. Empty values
+        and values that are not a date in this format become NaT (not a time).
+
+        :param datelist: a list of datestrings (MM/DD/YYYY)
+        :return: pandas series of dates (datetime64)
+        """
+        return pd.to_datetime(pd.Series(datelist, dtype=object), format='%m/%d/%Y', errors='coerce')
+
+    def to_dates(self, datelist):
+        """
+        This function converts a list of datestrings (MM/DD/YYYY) to a list of date objects, the empty values are
+        left out. The dates are parsed in one go using to_datetimes(), only values that it couldn't parse are parsed
+        again using to_date(). These are the dates pandas cannot represent (before 1677 or after 2262, like the
+        sentinel 12/31/9999) and the values that are not a date, which raise a ValueError.
+
+        :param datelist: a list of datestrings (MM/DD/YYYY)
+        :return: list of date objects, in the same order as the datestrings
+        """
+        # datetime64[us] converts to date objects (None for NaT):
+        dates = self.to_datetimes(datelist).to_numpy().astype('datetime64[us]').astype(object)
+        entries = list(datelist)
+        for i in np.flatnonzero(pd.isna(dates)):
+            if not self.is_empty(entries[i]):
+                dates[i] = self.to_date(entries[i])
+                if dates[i] is None:
+                    raise ValueError('{} is not a datestring in the form MM/DD/YYYY.'.format(entries[i]))
+        return [date for date in dates if date is not None]
+
     @staticmethod
     def truncate_date(dateobject):
         """
@@ -111,13 +157,8 @@ class HelperFunctions:
         :param inputlist: a list to transform to a querystring
         :return: a query string
         """
-        query_string = ""
-        for i in inputlist:
-            if not self.is_empty(i):  # ignore empty entries
-                query_string = query_string + "'{}', ".format(i)
-        # Remove the last character because we don't want to end in a comma:
-        query_string = query_string[:-2]
-        return query_string
+        # Quote the entries (ignoring empty entries) and join them with a comma in between:
+        return ', '.join("'{}'".format(i) for i in inputlist if not self.is_empty(i))
 
     def return_earliest_date(self, datelist):
         """
@@ -128,18 +169,8 @@ class HelperFunctions:
         :param datelist: a list of datestrings (MM/DD/YYYY)
         :return: earliest date as string (MM/DD/YYYY)
         """
-        # remove None values:
-        datelist = [i for i in datelist if not self.is_empty(i)]
-        if len(datelist) > 0:
-            # First, convert all dates in the list to datetime objects:
-            dates = [self.to_date(i) for i in datelist]
-            # Identify the earliest date and transform that to string again:
-            min_date = min(dates)
-            min_date = self.to_string(min_date)
-        else:
-            # There are no dates in the list, return None.
-            min_date = None
-        return min_date
+        # Identify the earliest date (empty values are ignored) and transform that to string again:
+        return self._reduce_dates(datelist, min)
 
     def return_latest_date(self, datelist):
         """
@@ -150,18 +181,24 @@ class HelperFunctions:
         :param datelist: a list of datestrings (MM/DD/YYYY)
         :return: latest date as string (MM/DD/YYYY)
         """
-        # remove None values:
-        datelist = [i for i in datelist if not self.is_empty(i)]
-        if len(datelist) > 0:
-            # First, convert all dates in the list to datetime objects:
-            dates = [self.to_date(i) for i in datelist]
-            # Identify the latest date and transform that to string again:
-            max_date = max(dates)
-            max_date = self.to_string(max_date)
-        else:
+        # Identify the latest date (empty values are ignored) and transform that to string again:
+        return self._reduce_dates(datelist, max)
+
+    def _reduce_dates(self, datelist, reduction):
+        """
+        This function parses a list of datestrings (MM/DD/YYYY) using to_dates() and reduces the dates to one date
+        using 'reduction' (min or max). The date objects are reduced, so also dates that pandas cannot represent
+        (like 12/31/9999) are taken into account. Empty values are ignored.
+
+        :param datelist: a list of datestrings (MM/DD/YYYY)
+        :param reduction: function that reduces a list to one value (min or max)
+        :return: the resulting date as string (MM/DD/YYYY), None if there are no dates in the list
+        """
+        dates = self.to_dates(datelist)
+        if len(dates) == 0:
             # There are no dates in the list, return None.
-            max_date = None
-        return max_date
+            return None
+        return self.to_string(reduction(dates))
 
     @staticmethod
     def transform_date(date_entry=str):
@@ -182,6 +219,16 @@ class HelperFunctions:
         :param date_entry: a string date
         :return: a string date in the form (MM/DD/YYYY)
         """
+        # Recognize the common formats and take the date parts in a single pass over the string:
+        match = _DATE_PATTERN.fullmatch(date_entry) if isinstance(date_entry, str) else None
+        if match is not None:
+            if match.group('iso_year') is not None:  # Equal to first format
+                return '{}/{}/{}'.format(match.group('iso_month'), match.group('iso_day'), match.group('iso_year'))
+            year = match.group('year')  # Equal to second to fifth format
+            if len(year) == 2:
+                year = '20' + year  # assumes 21st century
+            return '{}/{}/{}'.format(match.group('month'), match.group('day'), year)
+        # Other datestrings are split on the separators:
         if len(date_entry.split('T')) > 1:  # Equal to first format
             datepart = date_entry.split('T')[0].split('-')
             return_date = '{}/{}/{}'.format(datepart[1], datepart[2], datepart[0])
@@ -202,8 +249,14 @@ class HelperFunctions:
     @staticmethod
     def identify_duplicates(list_input=list):
         """
-        This function takes a list as input and returns a list with the values that are duplicated.
+        This function takes a list as input and returns a list with the values that are duplicated, in the order in
+        which they first appear in the list.
 
         """
-        output = [item for item, count in collections.Counter(list_input).items() if count > 1]
+        if not isinstance(list_input, np.ndarray) or list_input.dtype.kind not in 'biu':
+            # Converting a list (or an array of other types) to pandas takes longer than counting the values:
+            return [item for item, count in collections.Counter(list_input).items() if count > 1]
+        values = pd.Series(list_input)
+        # Keep all occurrences of the duplicated values, then only the first occurrence of each value:
+        output = list(values[values.duplicated(keep=False)].drop_duplicates().to_numpy())
         return output
@@ -44,15 +44,19 @@ class Logger:
     }
 
     def __init__(self, name_logger, logging_level, filename=None, filemode='a'):
-        if filename is not None:
-            # log to both file and std. out
-            handlers = [logging.FileHandler(filename, mode=filemode), logging.StreamHandler()]
-            logging.basicConfig(format='%(asctime)s | %(name)s | %(levelname)s | %(message)s',
-                                datefmt='%d-%b-%y %H:%M:%S',
-                                handlers=handlers)
-        else:
-            logging.basicConfig(format='%(asctime)s | %(name)s | %(levelname)s | %(message)s',
-                                datefmt='%d-%b-%y %H:%M:%S')
+        # The output is configured once, by the first Logger. Later calls of basicConfig are ignored anyway, so only
+        # open the logfile when it will be used:
+        if not logging.getLogger().handlers:
+            if filename is not None:
+                # log to both file and std. out
+                handlers = [logging.FileHandler(filename, mode=filemode), logging.StreamHandler()]
+                logging.basicConfig(format='%(asctime)s | %(name)s | %(levelname)s | %(message)s',
+                                    datefmt='%d-%b-%y %H:%M:%S',
+                                    handlers=handlers)
+            else:
+                logging.basicConfig(format='%(asctime)s | %(name)s | %(levelname)s | %(message)s',
+                                    datefmt='%d-%b-%y %H:%M:%S')
+        # getLogger returns the same logger object for the same name:
         self.logger = logging.getLogger(name_logger)
         # Check whether the logging_level is a string or integer, if string, make sure it is uppercase.
         if isinstance(logging_level, str):
@@ -7,6 +7,8 @@ __email__ = "chris.jacobs@bayer.com"
 
 # Imports
 import time
+import numpy as np
+import pandas as pd
 # Own modules:
 from Logging import Logger
 
@@ -22,16 +24,24 @@ class Optimize:
     def __init__(self, loglevel='INFO'):
         self.logger = Logger('DataAccess.ReadData', loglevel).logger
 
-    def compare_sql_queries(self, sql1, sql2, tr_connected):
+    def compare_sql_queries(self, sql1, sql2, tr_connected, use_hashes=False):
         """
         This runs 2 slq queries and checks whether the returned values are the same for both queries. It also
         logs the time taken for both queries. This function can be used to verify that 2 queries indeed return the
         same values when optimizing SQL code.
 
+        With use_hashes=True the rows of both results are first compared using a 64-bit hash per row, independent of
+        the order of the rows, which is much cheaper than sorting large results. If the hashes are the same, the
+        results are considered the same without sorting them (two different results getting the same hashes is
+        extremely unlikely). Otherwise the sorted results are compared value by value as usual, so values that are
+        equal but hash differently (like 0.0 and -0.0) still count as the same.
+
         :param sql1: sql query 1
         :param sql2: sql query 2
         :param tr_connected: An initiated instance of the Teradata class of DataAccess.py
-        :return: True if the queries have the same result, False otherwise., df1 and df2
+        :param use_hashes: (OPTIONAL) first compare the row hashes (default=False)
+        :return: True if the queries have the same result, False otherwise., df1 and df2 (sorted on all columns, unless
+            use_hashes=True and the hashes are the same)
         """
         # Run query 1:
         time0 = time.time()
@@ -42,6 +52,13 @@ class Optimize:
         df2 = tr_connected.retrieve_dataframe(sql2)
         duration2 = time.time() - time0
         self.logger.info('SQL query 1 took {} seconds ; SQL query 2 took {} seconds.'.format(duration1, duration2))
+        if use_hashes and df1.shape == df2.shape and list(df1.columns) == list(df2.columns) and \
+                list(df1.dtypes) == list(df2.dtypes):
+            # Compare the sorted row hashes, sorting these is much cheaper than sorting the dataframes on all columns:
+            hashes1 = np.sort(pd.util.hash_pandas_object(df1, index=False).to_numpy())
+            hashes2 = np.sort(pd.util.hash_pandas_object(df2, index=False).to_numpy())
+            if np.array_equal(hashes1, hashes2):
+                return True, df1, df2
         # Sort both dataframes on all columns to ensure that they are ordered in the same way:
         df1.sort_values(by=list(df1.columns), inplace=True, ignore_index=True)
         df2.sort_values(by=list(df2.columns), inplace=True, ignore_index=True)
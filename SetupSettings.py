@@ -1,4 +1,6 @@
 import argparse
+# Own modules:
+from Logging import Logger
 
 
 class CreateSettings:
@@ -40,12 +42,13 @@ class CreateSettings:
         This function creates the basic parser with arguments that are always added.
 
         Arguments added are:
-         - -l / --log_level (default=INFO)
+         - -l / --log_level (default=INFO), converted to uppercase and checked when parsing
          - -w / --work_dir
 
         """
         parser = argparse.ArgumentParser(description=descr)
-        parser.add_argument('-l', '--log_level', help='Set log level (DEBUG/INFO/ERROR)', default='INFO')
+        parser.add_argument('-l', '--log_level', help='Set log level (DEBUG/INFO/ERROR)', default='INFO',
+                            type=str.upper, choices=[key for key in Logger.loglevel_dict if type(key) is str])
         parser.add_argument('-w', '--work_dir', help='Full path to workdir (saving temp files)')
         return parser
 
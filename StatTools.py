@@ -5,10 +5,8 @@ __author__ = "Chris Jacobs"
 __version__ = "0.1"
 __email__ = "chris.jacobs@bayer.com"
 
-import matplotlib.pyplot as plt
-import statsmodels.stats.diagnostic as ssd
-import scipy.stats as stats
-import statistics
+# matplotlib, numpy, scipy and statsmodels are imported in the functions that use them, importing them takes a
+# few seconds which is not needed when this module is imported but no model is analysed.
 
 
 class LmAssumptions:
@@ -69,13 +67,18 @@ class LmAssumptions:
 
         :return: a matplotlib figure object with the plots and a results list with the test output.
         """
+        import matplotlib.pyplot as plt
+        import statsmodels.stats.diagnostic as ssd
+
         results_list = []
         fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(12, 6))
+        # The standardized residuals are used by both plots, computing the influence is expensive for large models:
+        standardized_residuals = self.model.get_influence().resid_studentized_internal
         # Plot a standardized residuals plot to check for linearity and equal variance
         # Also check for outliers (More than 2 standard deviations warrent investigation):
-        self._plot_standardized_residuals(ax1)
+        self._plot_standardized_residuals(ax1, standardized_residuals)
         # QQ plot
-        self._plot_qq(ax2)
+        self._plot_qq(ax2, standardized_residuals)
         # Test for linearity, doesn't seem to work when using squared terms:
         pred_val = self.model.fittedvalues
         residual = self.y - pred_val
@@ -104,32 +107,32 @@ class LmAssumptions:
 
         return fig, results_list
 
-    def _plot_standardized_residuals(self, ax):
+    def _plot_standardized_residuals(self, ax, standardized_residuals):
         """
         This function creates a standardized residuals vs fitted values plot to inspect for problems with
         heteroscedasticity.
 
         :param ax: Matplotlib axes-object
+        :param standardized_residuals: the (internally studentized) residuals of the model
         :return: Matplotlib axes-object
         """
         pred_val = self.model.fittedvalues
-        influence = self.model.get_influence()
-        standardized_residuals = influence.resid_studentized_internal
         ax.scatter(pred_val, standardized_residuals, s=1)
         ax.set_xlabel('Fitted Value')
         ax.set_ylabel('Standardized Residuals')
         return ax
 
-    def _plot_qq(self, ax):
+    def _plot_qq(self, ax, standardized_residuals):
         """
         This function creates a QQ-plot (Quantile-Quantile plot) to inspect whether the data follows a normal
         distribution. It uses scipy.
 
         :param ax: Matplotlib axes-object
+        :param standardized_residuals: the (internally studentized) residuals of the model
         :return: Matplotlib axes-object
         """
-        influence = self.model.get_influence()
-        standardized_residuals = influence.resid_studentized_internal
+        import scipy.stats as stats
+
         p_shapiro, p_ks = self._test_normality(standardized_residuals)
         stats.probplot(standardized_residuals, dist='norm', plot=ax)
         if p_shapiro is not None:
@@ -151,6 +154,9 @@ class LmAssumptions:
         :param var: data to be tested for normality (numpy array)
         :return: p-value of the Shapiro test, p-value of the KS test.
         """
+        import numpy as np
+        import scipy.stats as stats
+
         try:
             shapiro_res = stats.shapiro(var)
             p_shapiro = shapiro_res[1]
@@ -158,8 +164,11 @@ class LmAssumptions:
             p_shapiro = None
 
         try:
-            average = statistics.mean(var)
-            stdeviation = statistics.stdev(var)
+            var = np.asarray(var, dtype=float)
+            if len(var) < 2:
+                raise ValueError('The standard deviation needs at least two data points.')
+            average = np.mean(var)
+            stdeviation = np.std(var, ddof=1)  # sample standard deviation, like statistics.stdev()
             ks_res = stats.kstest(var, 'norm', args=(average, stdeviation))
             p_ks = ks_res[1]
         except ValueError:
@@ -7,11 +7,16 @@ __email__ = "chris.jacobs@bayer.com"
 
 import time
 import os
+import functools
+import numpy as np
 import pandas as pd
 # Own modules
 from Logging import Logger
 from DataAccess import ReadData
 
+# The folder with the sql queries used in this module:
+_QUERIES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Queries')
+
 
 class Transform:
 
@@ -25,6 +30,11 @@ class Transform:
 
     acre = 4046.8564224
     hectare = 10000
+    # Per supported uom: (multiplier or divisor, output uom):
+    _QUANTITY_TABLE = {'KPS': (1, 'KG'), 'KCS': (1, 'KG'), 'MK': (1, 'MK')}
+    _RATE_TABLE = {'KG/HAR': (hectare, 'KG/M2'), 'KG/M2': (1, 'KG/M2'), 'MK/HAR': (hectare, 'MK/M2'),
+                   'MK/M2': (1, 'MK/M2')}
+    _AREA_TABLE = {'M2': (1, 'M2'), 'HAR': (hectare, 'M2'), 'ACR': (acre, 'M2')}
 
     def __init__(self, loglevel='INFO'):
         self.logger = Logger('Transformations.Transform', loglevel).logger
@@ -42,15 +52,26 @@ class Transform:
         :param uom: input uom
         :return: transformed quantity, output uom
         """
-        uom_supported = ['KPS', 'KCS', 'MK']
-        uom_out = uom
-        if uom not in uom_supported:
-            self._uom_not_supported(self.transform_quantity.__name__, uom, uom_supported)
+        if uom not in self._QUANTITY_TABLE:
+            self._uom_not_supported(self.transform_quantity.__name__, uom, list(self._QUANTITY_TABLE))
             return None, None
-        if uom == 'KPS' or uom == 'KCS':
-            uom_out = 'KG'
+        multiplier, uom_out = self._QUANTITY_TABLE[uom]
+        if multiplier != 1:
+            quantity = quantity * multiplier
         return quantity, uom_out
 
+    def transform_quantity_series(self, quantities, uoms):
+        """
+        This function transforms a pandas column of quantities at once, see transform_quantity().
+        Quantities with an unsupported uom become NaN (with uom NaN).
+
+        :param quantities: pandas column of input quantities
+        :param uoms: pandas column of input uoms
+        :return: pandas column of transformed quantities, pandas column of output uoms
+        """
+        multipliers, uoms_out = self._lookup_uoms(self.transform_quantity_series.__name__, uoms, self._QUANTITY_TABLE)
+        return quantities * multipliers, uoms_out
+
     def transform_rate(self, rate, uom):
         """
         This function transforms the rate (weight per area or number per area) to a common output. For the weight it
@@ -63,19 +84,26 @@ class Transform:
         :param uom: input uom
         :return: transformed rate, output uom
         """
-        uom_supported = ['KG/HAR', 'KG/M2', 'MK/HAR', 'MK/M2']
-        uom_out = uom
-        if uom not in uom_supported:
-            self._uom_not_supported(self.transform_rate.__name__, uom, uom_supported)
+        if uom not in self._RATE_TABLE:
+            self._uom_not_supported(self.transform_rate.__name__, uom, list(self._RATE_TABLE))
             return None, None
-        if uom == 'KG/HAR':
-            rate = rate / self.hectare
-            uom_out = 'KG/M2'
-        if uom == 'MK/MK' or uom == 'MK/HAR':
-            rate = rate / self.hectare
-            uom_out = 'MK/M2'
+        divisor, uom_out = self._RATE_TABLE[uom]
+        if divisor != 1:
+            rate = rate / divisor
         return rate, uom_out
 
+    def transform_rate_series(self, rates, uoms):
+        """
+        This function transforms a pandas column of rates at once, see transform_rate().
+        Rates with an unsupported uom become NaN (with uom NaN).
+
+        :param rates: pandas column of input rates
+        :param uoms: pandas column of input uoms
+        :return: pandas column of transformed rates, pandas column of output uoms
+        """
+        divisors, uoms_out = self._lookup_uoms(self.transform_rate_series.__name__, uoms, self._RATE_TABLE)
+        return rates / divisors, uoms_out
+
     def transform_area(self, area, uom):
         """
         This function takes an area as input and returns the area in M2.
@@ -86,16 +114,43 @@ class Transform:
         :param uom: input uom
         :return: area in m2
         """
-        uom_supported = ['M2', 'HAR', 'ACR']
-        if uom not in uom_supported:
-            self._uom_not_supported(self.transform_area.__name__, uom, uom_supported)
+        if uom not in self._AREA_TABLE:
+            self._uom_not_supported(self.transform_area.__name__, uom, list(self._AREA_TABLE))
             return None
-        if uom == 'HAR':
-            area = area * self.hectare
-        elif uom == 'ACR':
-            area = area * self.acre
+        multiplier = self._AREA_TABLE[uom][0]
+        if multiplier != 1:
+            area = area * multiplier
         return area
 
+    def transform_area_series(self, areas, uoms):
+        """
+        This function transforms a pandas column of areas to m2 at once, see transform_area().
+        Areas with an unsupported uom become NaN.
+
+        :param areas: pandas column of input areas
+        :param uoms: pandas column of input uoms
+        :return: pandas column of areas in m2
+        """
+        multipliers, _ = self._lookup_uoms(self.transform_area_series.__name__, uoms, self._AREA_TABLE)
+        return areas * multipliers
+
+    def _lookup_uoms(self, name, uoms, table):
+        """
+        This function maps a pandas column of uoms to the multipliers (or divisors) and output uoms in 'table'.
+        Unsupported uoms are logged and get NaN for both.
+
+        :param name: name of the calling function, used for logging
+        :param uoms: pandas column of input uoms
+        :param table: dictionary {uom: (multiplier or divisor, output uom)}
+        :return: pandas column of multipliers (or divisors), pandas column of output uoms
+        """
+        factors = uoms.map({uom: factor for uom, (factor, _) in table.items()})
+        uoms_out = uoms.map({uom: uom_out for uom, (_, uom_out) in table.items()})
+        unsupported = uoms[factors.isna()].unique()
+        if len(unsupported) > 0:
+            self._uom_not_supported(name, list(unsupported), list(table))
+        return factors, uoms_out
+
     def _uom_not_supported(self, name, uom, uom_supported):
         self.logger.error("{}: uom {} currently not supported, supported uom's are: {}".format(name, uom,
                                                                                                uom_supported))
@@ -109,8 +164,14 @@ class Exchange:
 
     'td' is a Teradata connection object  (DataAccess -> Teradata)
 
+    Use convert_to_usd_batch() or convert_to_eur_batch() to convert many amounts at once, this is much faster than
+    calling convert_to_usd() or convert_to_eur() per amount.
+
     """
 
+    # The exchange rate query per min_date, so the query file is only read once:
+    _cached_sql = {}
+
     def __init__(self, td, min_date='2015-01-01', loglevel='INFO'):
         self.logger = Logger('Transformations.Exchange', loglevel).logger
         self.rd = ReadData(loglevel=loglevel)
@@ -119,6 +180,11 @@ class Exchange:
         # Create a subset for to EUR and to USD so we only need to do that once:
         self.to_usd = exchange_df[(exchange_df['TO_CRNCY_CD'] == 'USD')]
         self.to_eur = exchange_df[(exchange_df['TO_CRNCY_CD'] == 'EUR')]
+        # Index the exchange rates once, so the rates can be looked up by date using a binary search:
+        self._usd_rates = self._index_rates(self.to_usd)
+        self._eur_rates = self._index_table(self.to_eur)
+        # The same uom and exchange date are often converted many times, cache the looked up rates per object:
+        self._lookup_rate = functools.lru_cache(maxsize=4096)(self._lookup_rate)
 
     def _retrieve_exchange_rates(self, min_date):
         """
@@ -130,20 +196,124 @@ class Exchange:
         """
         time0 = time.time()
         self.logger.info('Retrieving exchange rates.')
-        # Read the query:
-        sql_file = os.path.dirname(os.path.abspath(__file__)) + '/Queries/exchange_rates.sql'
-        # Create a replace dictionary for the query:
-        replace_dict = {'$DATE1$': min_date}
-        sql = self.rd.read_sql(sql_file, replace_dict)
+        # Read the query (once per min_date):
+        if min_date not in Exchange._cached_sql:
+            sql_file = os.path.join(_QUERIES_DIR, 'exchange_rates.sql')
+            # Create a replace dictionary for the query:
+            replace_dict = {'$DATE1$': min_date}
+            Exchange._cached_sql[min_date] = self.rd.read_sql(sql_file, replace_dict)
+        sql = Exchange._cached_sql[min_date]
         # Run the query:
         df = self.td.retrieve_dataframe(sql)
         # Format the dates, replace the year 9999 to 2200 because pandas cannot deal with the year 9999:
         df['VALID_FROM_DT'] = pd.to_datetime(df['VALID_FROM_DT'], format='%m/%d/%Y')
-        df['VALID_TO_DT'] = df['VALID_TO_DT'].replace(['12/31/9999'], '12/31/2200')
+        df.loc[df['VALID_TO_DT'].to_numpy() == '12/31/9999', 'VALID_TO_DT'] = '12/31/2200'
         df['VALID_TO_DT'] = pd.to_datetime(df['VALID_TO_DT'], format='%m/%d/%Y')
         self.logger.info('Exchange rates retrieved in {} seconds.'.format(time.time() - time0))
         return df
 
+    def _index_rates(self, rates_df):
+        """
+        This function indexes the exchange rates (see _index_table) per currency to convert from.
+
+        :param rates_df: the exchange rates to USD (self.to_usd)
+        :return: dictionary {from currency: indexed exchange rates}
+        """
+        return {currency: self._index_table(group) for currency, group in rates_df.groupby('FROM_CRNCY_CD', sort=False)}
+
+    @staticmethod
+    def _index_table(rates_df):
+        """
+        This function stores the valid from dates, the valid to dates and the exchange rates as numpy arrays, so the
+        rates for dates can be looked up quickly (see _lookup_rates). If the periods don't overlap, only one rate can
+        be valid on a date and the arrays are sorted by valid from date, so the rate can be found using a binary
+        search. Otherwise the rows keep the order of the query, because the first valid rate is used.
+
+        :param rates_df: exchange rates (a subset of self.to_usd or self.to_eur)
+        :return: tuple (valid from dates, valid to dates, exchange rates, whether the periods overlap)
+        """
+        valid_from = rates_df['VALID_FROM_DT'].to_numpy()
+        valid_to = rates_df['VALID_TO_DT'].to_numpy()
+        exchange_rates = rates_df['EXCHG_RT_VAL'].to_numpy(dtype=float)
+        order = np.argsort(valid_from, kind='mergesort')
+        # Two periods overlap if a period starts before the previous one (sorted by valid from date) has ended:
+        overlapping = bool((valid_from[order][1:] <= valid_to[order][:-1]).any())
+        if overlapping:
+            return valid_from, valid_to, exchange_rates, overlapping
+        return valid_from[order], valid_to[order], exchange_rates[order], overlapping
+
+    @staticmethod
+    def _lookup_rates(table, dates):
+        """
+        This function looks up the exchange rates for an array of dates in exchange rates indexed by _index_table().
+        When multiple rates are valid on a date, the first one (in the order of the query) is used. Dates on which no
+        exchange rate is valid get NaN as exchange rate.
+
+        :param table: the indexed exchange rates (see _index_table)
+        :param dates: numpy array of dates (datetime64)
+        :return: tuple (numpy array with the exchange rate per date, numpy array with the number of valid rates)
+        """
+        valid_from, valid_to, exchange_rates, overlapping = table
+        if len(valid_from) == 0:
+            return np.full(len(dates), np.nan), np.zeros(len(dates), dtype=int)
+        if not overlapping:
+            # The last rate that became valid on or before the date, check that it is still valid on that date:
+            idx = np.searchsorted(valid_from, dates, side='right') - 1
+            found = idx >= 0
+            idx[~found] = 0
+            found &= valid_to[idx] >= dates
+            return np.where(found, exchange_rates[idx], np.nan), found.astype(int)
+        # Overlapping periods, check all rates per unique date:
+        unique_dates, inverse = np.unique(dates, return_inverse=True)
+        rates = np.full(len(unique_dates), np.nan)
+        counts = np.zeros(len(unique_dates), dtype=int)
+        for i, date in enumerate(unique_dates):
+            valid = np.flatnonzero((valid_from <= date) & (valid_to >= date))
+            if len(valid) > 0:
+                rates[i] = exchange_rates[valid[0]]
+                counts[i] = len(valid)
+        return rates[inverse], counts[inverse]
+
+    def _lookup_rate(self, to_currency, uom, exchange_date):
+        """
+        This function looks up the exchange rate for a currency for one date, see _lookup_rates(). The results are
+        cached (see __init__).
+
+        :param to_currency: the currency to convert to (USD/EUR).
+        :param uom: the currency to convert from (EUR/USD etc.), not used for EUR (all rates to EUR are from USD).
+        :param exchange_date: the date to use to determine the exchange rate (MM/DD/YYYY)
+        :return: tuple (the exchange rate, None if there is none, the number of valid rates)
+        """
+        if to_currency == 'USD':
+            if uom not in self._usd_rates:
+                return None, 0
+            table = self._usd_rates[uom]
+        else:
+            table = self._eur_rates
+        rates, counts = self._lookup_rates(table, np.array([pd.Timestamp(exchange_date).to_datetime64()]))
+        if counts[0] == 0:
+            return None, 0
+        return float(rates[0]), int(counts[0])
+
+    def _exchange_rate(self, to_currency, uom, exchange_date):
+        """
+        This function returns the exchange rate to USD or EUR for a currency and date (see _lookup_rate). It raises an
+        IndexError if no exchange rate is valid on the date and logs a warning if multiple rates are valid.
+
+        :param to_currency: the currency to convert to (USD/EUR).
+        :param uom: the current unit of measurement (EUR/USD etc.)
+        :param exchange_date: the date to use to determine the exchange rate (MM/DD/YYYY)
+        :return: the exchange rate
+        """
+        exchange_rate, count = self._lookup_rate(to_currency, uom, exchange_date)
+        if count == 0:
+            raise IndexError('No {} exchange rate for uom {} is valid on exchange date {}.'
+                             .format(to_currency, uom, exchange_date))
+        if count > 1:
+            self.logger.warning('Multiple possible {} exchange rates found for uom {} and exchange date {}.'
+                                .format(to_currency, uom, exchange_date))
+        return exchange_rate
+
     def convert_to_usd(self, amount, uom, exchange_date):
         """
         This function transforms the input 'amount' to USD.
@@ -157,16 +327,64 @@ class Exchange:
             usd = amount
         else:
             # Identify the exchange rate from the uom to USD:
-            sub_exchange_df = self.to_usd[(self.to_usd['FROM_CRNCY_CD'] == uom) &
-                                          (self.to_usd['VALID_FROM_DT'] <= exchange_date) &
-                                          (self.to_usd['VALID_TO_DT'] >= exchange_date)]
-            exchange_rate = sub_exchange_df['EXCHG_RT_VAL'].tolist()[0]  # take first value, should only be one
-            if len(sub_exchange_df) > 1:
-                self.logger.warning('Multiple possible USD exchange rates found for uom {} and exchange date {}.'
-                                    .format(uom, exchange_date))
-            usd = amount * exchange_rate
+            usd = amount * self._exchange_rate('USD', uom, exchange_date)
+        return usd
+
+    def convert_to_usd_batch(self, amounts, uoms, exchange_dates):
+        """
+        This function transforms many amounts to USD at once, see convert_to_usd(). The exchange rates are looked up
+        per currency for all dates in one go, which is much faster than converting the amounts one by one.
+
+        :param amounts: the currency amounts (list, numpy array or pandas column)
+        :param uoms: the current unit of measurement per amount (EUR/USD etc.)
+        :param exchange_dates: the date per amount to use to determine the exchange rate (MM/DD/YYYY)
+        :return: numpy array with the amounts in USD, NaN if there is no exchange rate for the uom and exchange date.
+        """
+        amounts = np.asarray(amounts, dtype=float)
+        usd, multiple = self._usd_batch(amounts, np.asarray(uoms, dtype=object),
+                                        pd.to_datetime(np.asarray(exchange_dates)).to_numpy())
+        self._log_batch('USD', usd, amounts, multiple)
         return usd
 
+    def _usd_batch(self, amounts, uoms, dates):
+        """
+        This function converts many amounts to USD at once, see convert_to_usd_batch().
+
+        :param amounts: numpy array with the currency amounts
+        :param uoms: numpy array with the current unit of measurement per amount (EUR/USD etc.)
+        :param dates: numpy array with the date per amount (datetime64)
+        :return: tuple (numpy array with the amounts in USD, numpy array that is True where multiple rates are valid)
+        """
+        usd = amounts.copy()  # USD amounts stay the same
+        multiple = np.zeros(len(amounts), dtype=bool)
+        for uom in pd.unique(uoms[uoms != 'USD']):
+            rows = np.flatnonzero(uoms == uom)
+            if uom in self._usd_rates:
+                rates, counts = self._lookup_rates(self._usd_rates[uom], dates[rows])
+                usd[rows] = amounts[rows] * rates
+                multiple[rows] = counts > 1
+            else:
+                usd[rows] = np.nan
+        return usd, multiple
+
+    def _log_batch(self, to_currency, converted, amounts, multiple):
+        """
+        This function logs the amounts without a valid exchange rate and with multiple valid exchange rates after a
+        batch conversion.
+
+        :param to_currency: the currency converted to (USD/EUR).
+        :param converted: numpy array with the converted amounts
+        :param amounts: numpy array with the currency amounts
+        :param multiple: numpy array that is True where multiple exchange rates are valid
+        """
+        missing = np.isnan(converted) & ~np.isnan(amounts)
+        if missing.any():
+            self.logger.error('No {} exchange rate is valid on the exchange date of {} amounts, these are set to '
+                              'NaN.'.format(to_currency, missing.sum()))
+        if multiple.any():
+            self.logger.warning('Multiple possible {} exchange rates found for {} amounts, the first one is used.'
+                                .format(to_currency, multiple.sum()))
+
     def convert_to_eur(self, amount, uom, exchange_date):
         """
         This function transforms the input 'amount' to EUR.
@@ -182,13 +400,28 @@ class Exchange:
             eur = amount
         else:
             usd = self.convert_to_usd(amount, uom, exchange_date)
-            sub_eur = self.to_eur[(self.to_eur['VALID_FROM_DT'] <= exchange_date) &
-                                  (self.to_eur['VALID_TO_DT'] >= exchange_date)]
-            eur_exchange_rt = sub_eur['EXCHG_RT_VAL'].tolist()[0]  # take first value, should only be one
-            if len(sub_eur) > 1:
-                self.logger.warning('Multiple possible EUR exchange rates found for uom {} and exchange date {}.'
-                                    .format(uom, exchange_date))
-            eur = usd * eur_exchange_rt
+            eur = usd * self._exchange_rate('EUR', uom, exchange_date)
+        return eur
+
+    def convert_to_eur_batch(self, amounts, uoms, exchange_dates):
+        """
+        This function transforms many amounts to EUR at once, see convert_to_eur() and convert_to_usd_batch().
+
+        :param amounts: the currency amounts (list, numpy array or pandas column)
+        :param uoms: the current unit of measurement per amount (EUR/USD etc.)
+        :param exchange_dates: the date per amount to use to determine the exchange rate (MM/DD/YYYY)
+        :return: numpy array with the amounts in EUR, NaN if there is no exchange rate for the uom and exchange date.
+        """
+        amounts = np.asarray(amounts, dtype=float)
+        uoms = np.asarray(uoms, dtype=object)
+        dates = pd.to_datetime(np.asarray(exchange_dates)).to_numpy()
+        eur = amounts.copy()  # EUR amounts stay the same
+        rows = np.flatnonzero(uoms != 'EUR')
+        usd, multiple = self._usd_batch(amounts[rows], uoms[rows], dates[rows])
+        rates, counts = self._lookup_rates(self._eur_rates, dates[rows])
+        eur[rows] = usd * rates
+        self._log_batch('USD', usd, amounts[rows], multiple)
+        self._log_batch('EUR', eur[rows], usd, counts > 1)
         return eur
 
 
@@ -225,18 +458,24 @@ class Normalize:
 
         The output list = [0.083, 0.500, 0.800, 0.917]
 
-        NOTE: only positive values!
+        NOTE: only positive values! A list where all values are the same has no range, it raises a ZeroDivisionError.
+
+        A numpy array as input returns a numpy array, which saves converting the values to a list and back for
+        callers that continue with numpy.
 
-        :param inputlist: a list of input values (floats/integers)
+        :param inputlist: a list (or numpy array) of input values (floats/integers)
         :param buffer_percentage: percentage to buffer the range as integer, where 10 would be 10%.
-        :return: list of normalized values
+        :return: list (or numpy array) of normalized values
         """
-        min_val = min(inputlist)
-        max_val = max(inputlist)
+        values = np.asarray(inputlist, dtype=float)
+        min_val = values.min()
+        max_val = values.max()
         range_values = max_val - min_val
         if min_val < 0:
             self.logger.error('This function cannot process lists with negative values.')
-            output_list = []
+            normalized = np.empty(0)
+        elif range_values == 0:
+            raise ZeroDivisionError('This function cannot process lists where all values are the same.')
         else:
             buffer_size = (buffer_percentage / 100) * range_values
             # Update min, max and range values using the buffer. If min value is below 0, set to 0 instead.
@@ -245,7 +484,13 @@ class Normalize:
                 min_val = 0
             max_val = max_val + buffer_size
             range_values = max_val - min_val
-            # Normalize values:
-            output_list = [round((i - min_val) / range_values, 3) for i in inputlist]
-
-        return output_list
+            # Normalize values, in place on one new array instead of per value:
+            normalized = values - min_val
+            normalized /= range_values
+            # Round with Python's round(), np.round() rounds some values that are halfway between two decimals the
+            # other way:
+            normalized = np.array([round(value, 3) for value in normalized.tolist()])
+
+        if isinstance(inputlist, np.ndarray):
+            return normalized
+        return normalized.tolist()
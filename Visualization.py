@@ -7,6 +7,9 @@ __email__ = "chris.jacobs@bayer.com"
 
 from Logging import Logger
 import matplotlib.pyplot as plt
+from matplotlib.lines import Line2D
+import numpy as np
+import pandas as pd
 
 
 class Plotting:
@@ -41,13 +44,19 @@ class Plotting:
         :param labelsize: (Optional) how large the x- and y-ticks should be (Default=8)
         :return: a matplotlib figure object with the plot.
         """
-        fig, ax = plt.subplots()
+        # constrained_layout fits the labels when the figure is drawn, no extra tight_layout pass is needed:
+        fig, ax = plt.subplots(constrained_layout=True)
         ax.margins(0.05)  # Optional, just adds 5% padding to the autoscaling
         if grouping_var is not None:
-            groups = df.groupby(grouping_var)
-            for nm, group in groups:
-                ax.plot(group[x_var], group[y_var], marker='o', linestyle='', ms=2, label=nm)
-            ax.legend()
+            # Draw all points at once colored by their group instead of one line per group, the colors follow the
+            # default color cycle in the same (sorted) order as the groups:
+            codes, groups = pd.factorize(df[grouping_var], sort=True)
+            cycle = plt.rcParams['axes.prop_cycle'].by_key()['color']
+            colors = np.array([cycle[i % len(cycle)] for i in range(len(groups))])
+            in_group = codes >= 0  # points without a group (NaN) are not plotted
+            ax.scatter(df[x_var].to_numpy()[in_group], df[y_var].to_numpy()[in_group], c=colors[codes[in_group]], s=4)
+            ax.legend(handles=[Line2D([], [], marker='o', linestyle='', ms=2, color=color, label=nm)
+                               for nm, color in zip(groups, colors)])
         else:
             if color is None:
                 ax.plot(df[x_var], df[y_var], marker='o', linestyle='', ms=2)
@@ -63,8 +72,7 @@ class Plotting:
             ax.set_ylabel(y_var)
         if title is not None:
             fig.suptitle(title)
-        plt.xticks(rotation=x_rotation, fontsize=labelsize)
-        plt.yticks(rotation=y_rotation, fontsize=labelsize)
-        plt.tight_layout()
+        ax.tick_params(axis='x', labelrotation=x_rotation, labelsize=labelsize)
+        ax.tick_params(axis='y', labelrotation=y_rotation, labelsize=labelsize)
         self.logger.info('Scatterplot created.')
         return fig
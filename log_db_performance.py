@@ -14,8 +14,8 @@ __email__ = "chris.jacobs@bayer.com"
 # Imports:
 import argparse
 import time
-import datetime
 import os
+import pandas as pd
 
 # Own modules:
 from DataAccess import Teradata, ReadData
@@ -45,38 +45,79 @@ except FileExistsError:
     # Directory already exists
     pass
 
-# Set the logfile and plotfile location:
+# Set the logfile, indexfile and plotfile location:
 logfile_location = settings.work_dir + '/sql_duration_log.txt'
+indexfile_location = settings.work_dir + '/sql_duration_log.idx'
 plotfile_location = settings.work_dir + '/sql_duration_plot.png'
 
-# Determine the value of the counter by reading the logfile if it exists, otherwise the index = 0.
-try:
-    df_index = rd.read_csv_to_df(logfile_location)
-    index = df_index['Index'].max() + 1  # set the index to the maximum value + 1
-except FileNotFoundError:
-    # file doesn't exist yet, create and set index to 0
+
+def read_last_index(logfile, index_file):
+    """
+    This function returns the index of the last line in the logfile. It is read from the index_file (which contains
+    the last index and the size of the logfile after writing that line), so the logfile doesn't need to be read. If
+    the index_file doesn't exist (yet) or doesn't match the size of the logfile (the logfile was recreated or
+    truncated), only the last part of the logfile is read to find the index of the last line (blank lines are
+    skipped). If that line has no index, the whole logfile is read and the highest index is returned.
+
+    :param logfile: the logfile with the durations
+    :param index_file: the file with the index of the last line in the logfile
+    :return: the index of the last line, -1 if the logfile is empty or only contains the header
+    """
+    log_size = os.path.getsize(logfile)
+    if log_size == 0:
+        return -1
+    try:
+        with open(index_file, 'r') as f:
+            last_index, index_log_size = f.read().split(',')
+        if int(index_log_size) == log_size:
+            return int(last_index)
+    except (FileNotFoundError, ValueError):
+        pass
+    with open(logfile, 'rb') as f:
+        f.seek(max(0, log_size - 4096))  # the last line is normally in the last 4 kB
+        lines = [line for line in f.read().splitlines() if line.strip()]
+    if lines:
+        try:
+            return int(lines[-1].split(b',')[0])
+        except ValueError:
+            pass
+    # Only the header is present or the last line has no index, read the indexes of the whole logfile:
+    last_index = pd.to_numeric(rd.read_csv_to_df(logfile, usecols=['Index'])['Index'], errors='coerce').max()
+    return -1 if pd.isna(last_index) else int(last_index)
+
+
+# Determine the value of the counter from the last line of the logfile if it exists, otherwise the index = 0.
+if os.path.exists(logfile_location) and os.path.getsize(logfile_location) > 0:
+    index = read_last_index(logfile_location, indexfile_location) + 1
+else:
+    # file doesn't exist yet (or is empty), create and set index to 0
     lf = open(logfile_location, 'a')
     lf.write('Index,Date/Time,Duration_in_seconds\n')  # write header
     lf.close()
     index = 0
 
 
-def time_query(sql_in, index_in, logfile):
+def time_query(sql_in, index_in, logfile, index_file):
     """
     This function runs the input sql query and times how long it took. It writes the current date/time and the duration
-    of the query execution to the logfile.
+    of the query execution to the logfile and the index of the written line and the size of the logfile to the
+    index_file.
 
     :param sql_in: SQL query to run
     :param index_in: the index of the line to write
     :param logfile: the logfile to write the duration to (will be appended)
+    :param index_file: the file with the index of the last line in the logfile (will be overwritten)
     """
-    time0 = time.time()  # start time
+    # perf_counter is monotonic with sub-microsecond resolution, use the integer nanoseconds to not lose precision:
+    time0 = time.perf_counter_ns()  # start time
     df = td.retrieve_dataframe(sql_in)
-    runtime = time.time() - time0  # duration in seconds
-    now = datetime.datetime.now().strftime("%d-%m-%Y %H:%M")
-    f = open(logfile, 'a')
-    f.write('{},{},{}\n'.format(index_in, now, runtime))
-    f.close()
+    runtime = (time.perf_counter_ns() - time0) / 1e9  # duration in seconds
+    now = time.strftime('%d-%m-%Y %H:%M')
+    # Write the complete line at once, so the logfile never contains half a line:
+    with open(logfile, 'a') as f:
+        f.write('{},{},{}\n'.format(index_in, now, runtime))
+    with open(index_file, 'w') as f:
+        f.write('{},{}'.format(index_in, os.path.getsize(logfile)))
 
 
 def plot_durations(logfile, plot_file):
@@ -86,12 +127,14 @@ def plot_durations(logfile, plot_file):
     :param logfile: location of the logfile to plot
     :param plot_file: save location for the plot
     """
-    df_in = rd.read_csv_to_df(logfile)
+    df_in = rd.read_csv_to_df(logfile, dtype_dict={'Duration_in_seconds': 'float32'})
+    # Parse the dates once, so matplotlib plots them as dates instead of converting each string:
+    df_in['Date/Time'] = pd.to_datetime(df_in['Date/Time'], format='%d-%m-%Y %H:%M', cache=True)
     fig = pl.scatter_plot('Date/Time', 'Duration_in_seconds', df_in, 'Date/time', 'Duration query execution in seconds',
                           x_rotation=45, labelsize=5)
     fig.savefig(plot_file, dpi=300)
 
 
 # Run the functions:
-time_query(sql, index, logfile_location)
+time_query(sql, index, logfile_location, indexfile_location)
 plot_durations(logfile_location, plotfile_location)
@@ -1,12 +1,14 @@
 import unittest
 import os
+from unittest import mock
 import numpy as np
 import pandas as pd
 from datetime import datetime
 # Own modules:
 from DataAccess import WriteData
-from Transformations import Transform, Normalize
+from Transformations import Transform, Normalize, Exchange
 from Helper_functions import HelperFunctions
+from Batch_history import ReconstructPaths
 
 
 class TestWriteData(unittest.TestCase):
@@ -25,46 +27,122 @@ class TestWriteData(unittest.TestCase):
 
         self.assertEqual(expected_outcome, outcome)
 
+    def test_save_df_csv(self):
+        """
+        This function tests that save_df() writes the same csv file as df.to_csv() by default, and that the optional
+        pyarrow csv writer writes the same values.
+
+        """
+        wd = WriteData()
+        df = pd.DataFrame({'a': [1, 2, 3], 'b': [1.0, 2.5, np.nan]})
+        expected_outcome = df.to_csv(index=False)
+        try:
+            wd.save_df(df, '.', 'save_df_test')
+            with open('save_df_test.csv', 'r') as f:
+                outcome = f.read()
+            wd.save_df(df, '.', 'save_df_test_pyarrow', csv_engine='pyarrow')
+            df_pyarrow = pd.read_csv('save_df_test_pyarrow.csv')
+        finally:
+            for filename in ['save_df_test.csv', 'save_df_test_pyarrow.csv']:
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+        self.assertEqual(expected_outcome, outcome)
+        pd.testing.assert_frame_equal(df, df_pyarrow, check_dtype=False)
+
 
 class TestTransformations(unittest.TestCase):
 
-    def test_transform_quantity(self):
-        tr = Transform(50)
-        input_values = [(34, 'KPS'), (0.01, 'KCS'), (2, 'MK'), (400, 'MG')]
-        expected_results = [(34, 'KG'), (0.01, 'KG'), (2, 'MK'), (None, None)]
-        results = [(tr.transform_quantity(quantity, uom)) for quantity, uom in input_values]
+    @classmethod
+    def setUpClass(cls):
+        cls.tr = Transform(50)
 
-        self.assertEqual(expected_results, results)
+    def test_transform_quantity(self):
+        cases = [(34, 'KPS', (34, 'KG')), (0.01, 'KCS', (0.01, 'KG')), (2, 'MK', (2, 'MK')), (400, 'MG', (None, None))]
+        for quantity, uom, expected_result in cases:
+            with self.subTest(uom=uom):
+                self.assertEqual(expected_result, self.tr.transform_quantity(quantity, uom))
 
     def test_transform_rate(self):
-        tr = Transform(50)
-        input_values = [(700, 'KG/HAR'), (0.45, 'KG/M2'), (200, 'MK/HAR'), (0.23, 'MK/M2'), (0.24, 'MK/MK')]
-        expected_results = [(0.07, 'KG/M2'), (0.45, 'KG/M2'), (0.02, 'MK/M2'), (0.23, 'MK/M2'), (None, None)]
-        results = [(tr.transform_rate(rate, uom)) for rate, uom in input_values]
-
-        self.assertEqual(expected_results, results)
+        cases = [(700, 'KG/HAR', (0.07, 'KG/M2')), (0.45, 'KG/M2', (0.45, 'KG/M2')), (200, 'MK/HAR', (0.02, 'MK/M2')),
+                 (0.23, 'MK/M2', (0.23, 'MK/M2')), (0.24, 'MK/MK', (None, None))]
+        for rate, uom, expected_result in cases:
+            with self.subTest(uom=uom):
+                self.assertEqual(expected_result, self.tr.transform_rate(rate, uom))
 
     def test_transform_area(self):
-        tr = Transform(50)
-        input_values = [(323, 'M2'), (0.123, 'HAR'), (1, 'ACR'), (300, 'cm2')]
-        expected_results = [323, 1230, 4046.8564224, None]
-        results = [tr.transform_area(area, uom) for area, uom in input_values]
+        cases = [(323, 'M2', 323), (0.123, 'HAR', 1230), (1, 'ACR', 4046.8564224), (300, 'cm2', None)]
+        for area, uom, expected_result in cases:
+            with self.subTest(uom=uom):
+                self.assertEqual(expected_result, self.tr.transform_area(area, uom))
 
-        self.assertEqual(expected_results, results)
+    def test_transform_series(self):
+        areas, area_uoms = pd.Series([323, 0.123, 1, 300]), pd.Series(['M2', 'HAR', 'ACR', 'cm2'])
+        rates, rate_uoms = pd.Series([700, 0.45, 200, 0.24]), pd.Series(['KG/HAR', 'KG/M2', 'MK/HAR', 'MK/MK'])
+        rates_out, rate_uoms_out = self.tr.transform_rate_series(rates, rate_uoms)
+
+        self.assertEqual([323, 1230, 4046.8564224], self.tr.transform_area_series(areas, area_uoms)[:3].tolist())
+        self.assertEqual([0.07, 0.45, 0.02], rates_out[:3].tolist())
+        self.assertEqual(['KG/M2', 'KG/M2', 'MK/M2'], rate_uoms_out[:3].tolist())
+        self.assertTrue(pd.isna(rates_out[3]) and pd.isna(rate_uoms_out[3]))
+
+
+class TestExchange(unittest.TestCase):
+
+    class FakeConnection:
+        """
+        This class replaces the Teradata connection, it returns a fixed set of exchange rates.
+
+        """
+        def retrieve_dataframe(self, sql):
+            # GBP has a long period and a shorter period that overlaps with it, USD to EUR changes once:
+            return pd.DataFrame({'FROM_CRNCY_CD': ['GBP', 'GBP', 'USD', 'USD'],
+                                 'TO_CRNCY_CD': ['USD', 'USD', 'EUR', 'EUR'],
+                                 'VALID_FROM_DT': ['01/01/2020', '03/01/2020', '01/01/2015', '01/01/2021'],
+                                 'VALID_TO_DT': ['12/31/2020', '03/31/2020', '12/31/2020', '12/31/9999'],
+                                 'EXCHG_RT_VAL': [1.25, 1.5, 0.5, 0.75]})
+
+    @classmethod
+    def setUpClass(cls):
+        # Skip reading the query file, the fake connection ignores the query:
+        with mock.patch('Transformations.ReadData.read_sql', return_value=''):
+            cls.ex = Exchange(cls.FakeConnection(), loglevel='CRITICAL')
+
+    def test_overlapping_rates(self):
+        """
+        This function tests that the first valid rate (in the order of the query) is used for overlapping periods,
+        that this is logged per lookup, and that a date without a valid rate raises an IndexError.
+
+        """
+        cases = [('02/15/2020', 1.25), ('03/15/2020', 1.25), ('04/15/2020', 1.25)]
+        for exchange_date, expected in cases:
+            with self.subTest(date=exchange_date):
+                self.assertEqual(expected, self.ex.convert_to_usd(1, 'GBP', exchange_date))
+        with self.assertLogs('Transformations.Exchange', 'WARNING'):
+            self.ex.convert_to_usd(1, 'GBP', '03/15/2020')
+        with self.assertRaises(IndexError):
+            self.ex.convert_to_usd(1, 'GBP', '01/15/2021')
+        dates = [exchange_date for exchange_date, _ in cases] + ['01/15/2021']
+        output = self.ex.convert_to_eur_batch([4] * len(dates), ['GBP'] * len(dates), dates)
+        np.testing.assert_array_equal([2.5, 2.5, 2.5, np.nan], output)
 
 
 class TestHelperFunctions(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        cls.hf = HelperFunctions(loglevel='ERROR')
+
     def test_is_empty(self):
         """
         This function checks the is_empty() function.
 
         """
-        hf = HelperFunctions(loglevel='ERROR')
         input_values = [1, 'not empty', '', ' ', 'a', np.nan, 'N/A']
         expected_output = [False, False, True, True, False, True, True]
-        output = [hf.is_empty(i) for i in input_values]
-        self.assertEqual(expected_output, output)
+        for i, expected in zip(input_values, expected_output):
+            with self.subTest(entry=i):
+                self.assertEqual(expected, self.hf.is_empty(i))
 
     def test_to_date(self):
         """
@@ -74,10 +152,9 @@ class TestHelperFunctions(unittest.TestCase):
         input_dates = ['01/12/2021', '12/06/1998', '01/31/1900', None, 1]
         expected_output = [datetime.strptime('01/12/2021', '%m/%d/%Y'), datetime.strptime('12/06/1998', '%m/%d/%Y'),
                            datetime.strptime('01/31/1900', '%m/%d/%Y'), None, None]
-        hf = HelperFunctions(loglevel='ERROR')
-        output = [hf.to_date(i) for i in input_dates]
-
-        self.assertEqual(expected_output, output)
+        for i, expected in zip(input_dates, expected_output):
+            with self.subTest(date=i):
+                self.assertEqual(expected, self.hf.to_date(i))
 
     def test_to_string(self):
         """
@@ -86,10 +163,20 @@ class TestHelperFunctions(unittest.TestCase):
         """
         expected_output = ['01/12/2021', '12/06/1998', '01/31/1900', None]
         input_dates = [datetime.strptime(i, '%m/%d/%Y') if i is not None else None for i in expected_output]
-        hf = HelperFunctions(loglevel='ERROR')
-        output = [hf.to_string(i) for i in input_dates]
+        for i, expected in zip(input_dates, expected_output):
+            with self.subTest(date=i):
+                self.assertEqual(expected, self.hf.to_string(i))
 
-        self.assertEqual(expected_output, output)
+    def test_to_dates(self):
+        """
+        This function tests the to_dates() function, including dates outside the range pandas supports.
+
+        """
+        input_dates = ['01/12/2021', '', '12/31/9999', None, '01/01/1500', np.nan]
+        expected_output = [datetime(2021, 1, 12), datetime(9999, 12, 31), datetime(1500, 1, 1)]
+        self.assertEqual(expected_output, self.hf.to_dates(input_dates))
+        with self.assertRaises(ValueError):
+            self.hf.to_dates(['01/12/2021', 'not a date'])
 
     def test_replace_empty_entries(self):
         """
@@ -97,14 +184,13 @@ class TestHelperFunctions(unittest.TestCase):
 
         """
         # Create a test df:
-        column1 = ['value1', 'value2', '', ' ', np.nan, 'value3', ' ']
+        column1 = ['value1', 'value2', '', ' ', np.nan, 'value3', '\u00A0']
         df = pd.DataFrame()
         df['column1'] = column1
         # Set expected output:
         expected_output = ['value1', 'value2', np.nan, np.nan, np.nan, 'value3', np.nan]
-        # Initiate the class and run the function:
-        hf = HelperFunctions(loglevel='ERROR')
-        df_out = hf.replace_empty_entries('column1', df)
+        # Run the function:
+        df_out = self.hf.replace_empty_entries('column1', df)
         output = df_out['column1'].tolist()
         # Compare:
         self.assertEqual(expected_output, output)
@@ -116,9 +202,8 @@ class TestHelperFunctions(unittest.TestCase):
         """
         list1 = [1234, 'hallo', '', None, 1, 'bla', 456, ' ']
         expected_output = "'1234', 'hallo', '1', 'bla', '456'"
-        # Initiate the class and run the function:
-        hf = HelperFunctions(loglevel='ERROR')
-        output = hf.list_to_querystring(list1)
+        # Run the function:
+        output = self.hf.list_to_querystring(list1)
         self.assertEqual(expected_output, output)
 
     def test_return_earliest_date(self):
@@ -129,12 +214,12 @@ class TestHelperFunctions(unittest.TestCase):
         datelists = [['12/15/2008', '12/16/2008', '11/30/2008'],
                      ['01/31/2018', '01/31/2021', '01/31/2028'],
                      ['03/03/2016', '12/17/2018', '01/01/2015'],
-                     ['', np.nan, None]]
-        expected_output = ['11/30/2008', '01/31/2018', '01/01/2015', None]
-        # Initiate the class and run the function:
-        hf = HelperFunctions(loglevel='ERROR')
-        output = [hf.return_earliest_date(datelist) for datelist in datelists]
-        self.assertEqual(expected_output, output)
+                     ['', np.nan, None],
+                     ['01/01/1500', '01/01/2020', '12/31/9999']]
+        expected_output = ['11/30/2008', '01/31/2018', '01/01/2015', None, '01/01/1500']
+        for datelist, expected in zip(datelists, expected_output):
+            with self.subTest(datelist=datelist):
+                self.assertEqual(expected, self.hf.return_earliest_date(datelist))
 
     def test_return_latest_date(self):
         """
@@ -144,24 +229,39 @@ class TestHelperFunctions(unittest.TestCase):
         datelists = [['12/15/2008', '12/16/2008', '11/30/2008'],
                      ['01/31/2018', '01/31/2021', '01/31/2028'],
                      ['03/03/2016', '12/17/2018', '01/01/2015'],
-                     ['', np.nan, None]]
-        expected_output = ['12/16/2008', '01/31/2028', '12/17/2018', None]
-        # Initiate the class and run the function:
-        hf = HelperFunctions(loglevel='ERROR')
-        output = [hf.return_latest_date(datelist) for datelist in datelists]
-        self.assertEqual(expected_output, output)
+                     ['', np.nan, None],
+                     ['01/01/1500', '01/01/2020', '12/31/9999']]
+        expected_output = ['12/16/2008', '01/31/2028', '12/17/2018', None, '12/31/9999']
+        for datelist, expected in zip(datelists, expected_output):
+            with self.subTest(datelist=datelist):
+                self.assertEqual(expected, self.hf.return_latest_date(datelist))
+
+    def test_identify_duplicates(self):
+        """
+        This function tests the identify_duplicates() function, the duplicated values are returned unchanged.
+
+        """
+        input_lists = [[1, None, 1, 2], [2**60 + 1, 2**60 + 1, None], ['b', 'a', 'a', 'b', 'c'], np.array([3, 1, 3, 1]),
+                       [datetime(2021, 1, 12), datetime(2021, 1, 12)], []]
+        expected_output = [[1], [2**60 + 1], ['b', 'a'], [3, 1], [datetime(2021, 1, 12)], []]
+        for input_list, expected in zip(input_lists, expected_output):
+            with self.subTest(input_list=input_list):
+                output = self.hf.identify_duplicates(input_list)
+                self.assertEqual(expected, output)
+                self.assertTrue(all(type(i) is type(input_list[0]) for i in output))
 
     def test_transform_date(self):
         """
         This function tests the transform_date() function.
 
         """
-        datelist = ['2021-03-22T14:37:28Z', '2021-05-25T08:20:25Z', '05/26/2021', '05/26/21', '05-26-2021', '05-26-21']
-        expected_output = ['03/22/2021', '05/25/2021', '05/26/2021', '05/26/2021', '05/26/2021', '05/26/2021']
-        # Initiate the class and run the function:
-        hf = HelperFunctions(loglevel='ERROR')
-        output = [hf.transform_date(i) for i in datelist]
-        self.assertEqual(expected_output, output)
+        datelist = ['2021-03-22T14:37:28Z', '2021-05-25T08:20:25Z', '05/26/2021', '05/26/21', '05-26-2021', '05-26-21',
+                    '05/26/2021 14:37', '2021-03-22 14:37:28', 'no date']
+        expected_output = ['03/22/2021', '05/25/2021', '05/26/2021', '05/26/2021', '05/26/2021', '05/26/2021',
+                           '05/26/2021 14:37', '2021/03/22 14:37:28', None]
+        for date_entry, expected in zip(datelist, expected_output):
+            with self.subTest(date=date_entry):
+                self.assertEqual(expected, self.hf.transform_date(date_entry))
 
 
 class TestNormalize(unittest.TestCase):
@@ -176,6 +276,81 @@ class TestNormalize(unittest.TestCase):
                             [0.057, 0.229, 0.343, 0.914]]
         output = [nm.normalize_list(i, 10) for i in input_lists]
         self.assertEqual(expected_outcome, output)
+        # Rounded like round() does, also for values halfway between two decimals:
+        self.assertEqual(0.637, nm.normalize_list(list(range(40, 1993)), 25)[1581 - 40])
+        with self.assertRaises(ZeroDivisionError):
+            nm.normalize_list([3, 3], 10)
+
+
+class TestReconstructPaths(unittest.TestCase):
+
+    def test_apply(self):
+        """
+        This function tests the apply() function, including a batch that is used by multiple descendants.
+
+        """
+        batch_dict = {'0190711962': ['0182548562', '0182548565', '0182778155'],
+                      '0182548562': ['0182299633'],
+                      '0182548565': ['0182268100'],
+                      '0182299633': ['0180875848'],
+                      'D': ['B', 'C'],
+                      'B': ['A'],
+                      'C': ['A', 'S'],
+                      'A': ['Z']}
+        expected_output = {'0190711962': [('0180875848', '0182299633', '0182548562', '0190711962'),
+                                          ('0182268100', '0182548565', '0190711962'),
+                                          ('0182778155', '0190711962')],
+                           'D': [('Z', 'A', 'B', 'D'),
+                                 ('Z', 'A', 'C', 'D'),
+                                 ('S', 'C', 'D')]}
+        # Initiate the class and run the function:
+        rp = ReconstructPaths(loglevel='ERROR')
+        output = rp.apply(batch_dict, ['0190711962', 'D'])
+        self.assertEqual(expected_output, output)
+
+    def test_iter_paths(self):
+        """
+        This function tests the iter_paths() function.
+
+        """
+        batch_dict = {'D': ['B', 'C'], 'B': ['A'], 'C': ['A', 'S'], 'A': ['Z']}
+        expected_output = [('Z', 'A', 'B', 'D'), ('Z', 'A', 'C', 'D'), ('S', 'C', 'D')]
+        # Initiate the class and run the function:
+        rp = ReconstructPaths(loglevel='ERROR')
+        output = list(rp.iter_paths(batch_dict, 'D'))
+        self.assertEqual(expected_output, output)
+
+    def test_apply_order(self):
+        """
+        This function tests the order of the paths returned by apply() for batches that share their history, and that
+        a batch with an empty list of FROM batches is not a source batch.
+
+        """
+        batch_dict = {'1': ['0'], '2': ['1', '0'], '3': ['1', '0', '2'], 'D': ['A', 'X'], 'X': [], 'A': ['S']}
+        expected_output = {'3': [('0', '1', '3'), ('0', '1', '2', '3'), ('0', '3'), ('0', '2', '3')],
+                           'D': [('S', 'A', 'D')],
+                           'X': []}
+        rp = ReconstructPaths(loglevel='ERROR')
+        output = rp.apply(batch_dict, ['3', 'D', 'X'])
+        self.assertEqual(expected_output, output)
+
+    def test_iter_all_paths(self):
+        """
+        This function tests the iter_all_paths() and nodes_reaching() functions on the edges of a collected history
+        (FROM Batch -> TO Batch), with an extra edge that does not lead to the destination.
+
+        """
+        batch_dict = {'D': ['B', 'C'], 'B': ['A'], 'C': ['A', 'S'], 'A': ['Z']}
+        expected_output = [('Z', 'A', 'B', 'D'), ('Z', 'A', 'C', 'D')]
+        # Initiate the class and collect the history of D:
+        rp = ReconstructPaths(loglevel='ERROR')
+        rp.collect_history(batch_dict, 'D')
+        edges = dict(rp.edges, A=rp.edges['A'] + ['E'], E=[])
+        reachable = rp.nodes_reaching('D', edges)
+        self.assertEqual({'Z', 'A', 'B', 'C', 'S', 'D'}, reachable)
+        self.assertEqual(expected_output, list(rp.iter_all_paths('Z', 'D', edges)))
+        self.assertEqual(expected_output, list(rp.iter_all_paths('Z', 'D', edges, reachable)))
+        self.assertEqual([('S', 'C', 'D')], list(rp.iter_all_paths('S', 'D', edges)))
 
 
 if __name__ == '__main__':